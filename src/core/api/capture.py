@@ -0,0 +1,377 @@
+import os
+import threading
+import time
+
+import cv2
+
+# ============================================================
+# RESILIENT CAPTURE: SETTINGS, HEALTH, WATCHDOG
+# ============================================================
+# Dùng bởi CameraManager (api/functions.py):
+# - mở cv2.VideoCapture với buffer size 1, FOURCC MJPG, resolution / FPS cấu hình sẵn
+# - mỗi source có một capture thread (SourceReader) đọc liên tục và giữ frame
+#   mới nhất, nên viewer chậm / đã ngắt không làm ngừng việc đọc camera
+# - theo dõi sức khỏe từng source (fps, lần đọc lỗi, số lần reconnect)
+# - watchdog phát hiện capture thread bị "đứng" trong read() và mở lại source
+#
+# Cấu hình qua biến môi trường:
+# - CAMERA_WIDTH / CAMERA_HEIGHT / CAMERA_FPS   (mặc định: không đổi giá trị của driver)
+# - CAMERA_FOURCC                               (mặc định MJPG, "" = không set)
+# - CAMERA_BUFFER_SIZE                          (mặc định 1)
+# - CAMERA_STALL_TIMEOUT                        (giây không có frame -> stalled, mặc định 3)
+# - CAMERA_READ_RETRIES                         (số lần đọc lại trước khi reopen, mặc định 3)
+# - CAMERA_RECONNECT_TIMEOUT                    (tổng thời gian thử reconnect, mặc định 15)
+# - CAMERA_BACKOFF_INITIAL / CAMERA_BACKOFF_MAX (mặc định 0.1 / 2.0 giây)
+# - CAMERA_IDLE_TIMEOUT                         (giây giữ camera mở sau stream / snapshot cuối,
+#                                                mặc định 30, 0 = đóng ngay khi stream dừng)
+# - CAMERA_VIDEO_FILE                           (đọc lặp file video thay cho mọi camera source,
+#                                                dùng cho load test / môi trường không có /dev/video0)
+
+class CaptureSettings:
+    def __init__(self):
+        self.width = int(os.getenv("CAMERA_WIDTH", "0"))
+        self.height = int(os.getenv("CAMERA_HEIGHT", "0"))
+        self.fps = float(os.getenv("CAMERA_FPS", "0"))
+        self.fourcc = os.getenv("CAMERA_FOURCC", "MJPG")
+        self.buffer_size = int(os.getenv("CAMERA_BUFFER_SIZE", "1"))
+        self.stall_timeout = float(os.getenv("CAMERA_STALL_TIMEOUT", "3"))
+        self.read_retries = int(os.getenv("CAMERA_READ_RETRIES", "3"))
+        self.reconnect_timeout = float(os.getenv("CAMERA_RECONNECT_TIMEOUT", "15"))
+        self.backoff_initial = float(os.getenv("CAMERA_BACKOFF_INITIAL", "0.1"))
+        self.backoff_max = float(os.getenv("CAMERA_BACKOFF_MAX", "2.0"))
+        self.idle_timeout = float(os.getenv("CAMERA_IDLE_TIMEOUT", "30"))
+        self.video_file = os.getenv("CAMERA_VIDEO_FILE", "")
+
+class LoopingVideoCapture:
+    """
+    Đọc file video như một camera: tua lại khi hết file và giữ đúng FPS của file
+    (read() chờ như camera thật thay vì trả frame nhanh nhất có thể).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        fps = self.cap.get(cv2.CAP_PROP_FPS) if self.cap.isOpened() else 0
+        self.interval = 1.0 / fps if fps and fps > 0 else 1.0 / 30
+        self._next = time.time()
+
+    def isOpened(self):
+        return self.cap.isOpened()
+
+    def read(self):
+        delay = self._next - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self._next = max(self._next + self.interval, time.time())
+
+        ret, frame = self.cap.read()
+        if not ret:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read()
+        return ret, frame
+
+    def grab(self):
+        return self.read()[0]
+
+    def set(self, prop, value):
+        return False
+
+    def get(self, prop):
+        return self.cap.get(prop)
+
+    def release(self):
+        self.cap.release()
+
+def open_capture(source, settings):
+    """
+    Mở capture và set các property để driver làm ít việc hơn.
+    Với source dạng URL (RTSP/HTTP) thì set thêm timeout để read() không bị treo.
+    """
+    if settings.video_file:
+        return LoopingVideoCapture(settings.video_file)
+
+    if isinstance(source, str):
+        timeout_ms = int(settings.stall_timeout * 1000)
+        params = []
+        if hasattr(cv2, "CAP_PROP_OPEN_TIMEOUT_MSEC"):
+            params = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, timeout_ms, cv2.CAP_PROP_READ_TIMEOUT_MSEC, timeout_ms]
+        cap = cv2.VideoCapture(source, cv2.CAP_ANY, params)
+    else:
+        cap = cv2.VideoCapture(source)
+
+    if not cap.isOpened():
+        return cap
+
+    if settings.buffer_size > 0:
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, settings.buffer_size)
+    if settings.fourcc:
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*settings.fourcc))
+    if settings.width:
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, settings.width)
+    if settings.height:
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, settings.height)
+    if settings.fps:
+        cap.set(cv2.CAP_PROP_FPS, settings.fps)
+    return cap
+
+class SourceHealth:
+    """Trạng thái của một capture source"""
+
+    def __init__(self, source):
+        self.source = source
+        self.state = "closed"
+        self.opened_at = None
+        self.last_frame_at = None
+        self.frames = 0
+        self.fps = 0.0
+        self.read_failures = 0
+        self.reconnects = 0
+        self.stalls = 0
+        self.last_error = None
+
+    def on_open(self):
+        self.state = "connected"
+        self.opened_at = time.time()
+        self.last_frame_at = None
+
+    def on_frame(self):
+        now = time.time()
+        if self.last_frame_at is not None:
+            gap = now - self.last_frame_at
+            if gap > 0:
+                self.fps = 0.9 * self.fps + 0.1 * (1.0 / gap) if self.fps else 1.0 / gap
+        self.last_frame_at = now
+        self.frames += 1
+        if self.state != "connected":
+            self.state = "connected"
+
+    def on_failure(self, error):
+        self.read_failures += 1
+        self.last_error = error
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            "source": self.source,
+            "state": self.state,
+            "uptime": round(now - self.opened_at, 1) if self.opened_at and self.state != "closed" else None,
+            "last_frame_age": round(now - self.last_frame_at, 3) if self.last_frame_at else None,
+            "frames": self.frames,
+            "fps": round(self.fps, 2),
+            "read_failures": self.read_failures,
+            "reconnects": self.reconnects,
+            "stalls": self.stalls,
+            "last_error": self.last_error
+        }
+
+class SourceReader:
+    """
+    Capture thread của một source: đọc frame liên tục (không phụ thuộc tốc độ của
+    consumer) và giữ frame mới nhất kèm số thứ tự (seq) và thời điểm capture.
+    Đọc lỗi thì đọc lại CAMERA_READ_RETRIES lần, sau đó reopen với exponential
+    backoff. Watchdog gọi restart() khi thread bị treo trong read().
+    """
+
+    def __init__(self, source, settings, health):
+        self.source = source
+        self.settings = settings
+        self.health = health
+        self.seq = 0
+        self.frame = None
+        self.frame_at = None
+        self.last_used = time.time()
+        self.users = 0
+        self.stopped = False
+        self._taps = []
+        self._cap = None
+        self._thread = None
+        self._generation = 0
+        self._cond = threading.Condition()
+
+    def start(self):
+        """Mở capture trên thread gọi (để báo lỗi ngay) rồi chạy capture thread"""
+        cap = open_capture(self.source, self.settings)
+        if not cap.isOpened():
+            cap.release()
+            self.health.state = "error"
+            self.health.last_error = f"Cannot open camera source: {self.source}"
+            return False
+        self.health.on_open()
+        self._spawn(cap)
+        return True
+
+    def _spawn(self, cap):
+        with self._cond:
+            self._generation += 1
+            self._cap = cap
+            self._thread = threading.Thread(target=self._run, args=(self._generation, cap),
+                                            name=f"capture-{self.source}", daemon=True)
+            self._thread.start()
+
+    def _current(self, generation):
+        return not self.stopped and generation == self._generation
+
+    def _reopen(self, generation):
+        """Mở lại capture với exponential backoff, tối đa CAMERA_RECONNECT_TIMEOUT giây"""
+        self.health.state = "reconnecting"
+        deadline = time.time() + self.settings.reconnect_timeout
+        backoff = self.settings.backoff_initial
+        while self._current(generation) and time.time() < deadline:
+            print(f"Reconnecting camera source: {self.source}")
+            self.health.reconnects += 1
+            cap = open_capture(self.source, self.settings)
+            if cap.isOpened():
+                with self._cond:
+                    if self._current(generation):
+                        self._cap = cap
+                        self.health.on_open()
+                        return cap
+                cap.release()
+                return None
+            cap.release()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.settings.backoff_max)
+        return None
+
+    def _run(self, generation, cap):
+        failures = 0
+        while self._current(generation):
+            if cap is None:
+                cap = self._reopen(generation)
+                if cap is None:
+                    break
+            ret, frame = cap.read()
+            if not self._current(generation):
+                # Bị stop() hoặc watchdog đã thay bằng thread khác trong lúc read()
+                break
+            if ret:
+                failures = 0
+                self.health.on_frame()
+                with self._cond:
+                    self.seq += 1
+                    self.frame = frame
+                    self.frame_at = time.time()
+                    taps = list(self._taps)
+                    self._cond.notify_all()
+                for tap in taps:
+                    try:
+                        tap(frame, self.frame_at)
+                    except Exception as e:
+                        print(f"Capture tap error ({self.source}): {e}")
+                continue
+            failures += 1
+            self.health.on_failure("read failed")
+            if failures > self.settings.read_retries:
+                # Không phải lỗi thoáng qua (USB / RTSP): đóng và mở lại
+                cap.release()
+                cap = None
+                failures = 0
+
+        if cap is not None:
+            cap.release()
+        with self._cond:
+            if self._current(generation):
+                self.stopped = True
+                self.health.state = "error"
+                self.health.last_error = f"Reconnect failed after {self.settings.reconnect_timeout}s"
+                print(f"Camera source {self.source}: {self.health.last_error}")
+            self._cond.notify_all()
+
+    def add_tap(self, tap):
+        """tap(frame, captured_at) được gọi trên capture thread cho mọi frame (phải nhanh)"""
+        with self._cond:
+            self._taps.append(tap)
+
+    def remove_tap(self, tap):
+        with self._cond:
+            if tap in self._taps:
+                self._taps.remove(tap)
+
+    def restart(self):
+        """
+        Thread hiện tại bị treo trong read(): đóng capture của nó (read() trả về lỗi,
+        hoặc thread bị bỏ lại và tự thoát khi read() trả về) và mở lại source trên
+        capture thread mới
+        """
+        with self._cond:
+            if self.stopped:
+                return
+            cap, self._cap = self._cap, None
+        if cap is not None:
+            cap.release()
+        self._spawn(None)
+
+    def stop(self, wait=1.0):
+        """Dừng capture thread; capture được đóng ngay khi read() đang chạy trả về"""
+        with self._cond:
+            self.stopped = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(wait)
+        self.health.state = "closed"
+
+    def next_frame(self, after_seq, timeout):
+        """
+        Frame mới hơn after_seq, chờ tối đa timeout giây.
+        Returns: (seq, frame, captured_at) hoặc None (chưa có frame mới / reader đã dừng).
+        Frame dùng chung giữa các consumer: không sửa trực tiếp.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            self.last_used = time.time()
+            while self.seq <= after_seq and not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            if self.stopped:
+                return None
+            return self.seq, self.frame, self.frame_at
+
+    def latest(self, max_age, timeout):
+        """Frame mới nhất nếu chưa quá max_age giây, nếu không thì chờ frame tiếp theo"""
+        with self._cond:
+            if self.frame is not None and not self.stopped and time.time() - self.frame_at <= max_age:
+                self.last_used = time.time()
+                return self.seq, self.frame, self.frame_at
+            after = self.seq
+        return self.next_frame(after, timeout)
+
+class CaptureWatchdog:
+    """
+    Thread nền kiểm tra các capture thread đang chạy. Nếu quá stall_timeout giây
+    reader không nhận được frame mới, source bị đánh dấu "stalled" và reader được
+    restart. Capture thread đọc độc lập với viewer nên viewer chậm hoặc đã ngắt
+    không bị tính là stall.
+    """
+
+    def __init__(self, readers, settings, interval=0.5):
+        self.readers = readers
+        self.settings = settings
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="capture-watchdog", daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            for reader in list(self.readers.values()):
+                health = reader.health
+                if reader.stopped or health.state != "connected":
+                    continue
+                since = health.last_frame_at or health.opened_at
+                if since is not None and now - since > self.settings.stall_timeout:
+                    health.state = "stalled"
+                    health.stalls += 1
+                    print(f"Camera source {health.source} stalled ({now - since:.1f}s without frames). Restarting capture.")
+                    reader.restart()
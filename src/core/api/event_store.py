@@ -0,0 +1,315 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from api.events import detections_changed
+
+# ============================================================
+# PERSISTENT DETECTION EVENT STORE (SQLITE WAL)
+# ============================================================
+# Lưu detections vào SQLite (WAL mode). Việc ghi được gom batch trong một
+# thread nền để không làm chậm vòng lặp inference. Bảng `hourly_counts`
+# được cập nhật cùng batch để các truy vấn thống kê theo giờ chỉ cần đọc
+# vài trăm dòng thay vì quét toàn bộ events.
+#
+# Cấu hình qua biến môi trường:
+# - EVENT_STORE_ENABLED         (1/0, mặc định 1)
+# - EVENT_STORE_PATH            (mặc định <core>/data/events.db)
+# - EVENT_STORE_MODE            (change | frame, mặc định change)
+# - EVENT_STORE_RETENTION_DAYS  (mặc định 30, 0 = giữ mãi mãi)
+# - EVENT_STORE_BATCH_SIZE      (mặc định 200)
+# - EVENT_STORE_FLUSH_INTERVAL  (giây, mặc định 1.0)
+
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "events.db")
+COMPACT_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    camera TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    human_count INTEGER NOT NULL,
+    badge_count INTEGER NOT NULL,
+    compliant INTEGER,
+    detections TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_camera_ts ON events (camera, ts);
+CREATE INDEX IF NOT EXISTS idx_events_ts ON events (ts);
+CREATE INDEX IF NOT EXISTS idx_events_compliant_ts ON events (compliant, ts);
+
+CREATE TABLE IF NOT EXISTS hourly_counts (
+    camera TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    hour INTEGER NOT NULL,
+    events INTEGER NOT NULL DEFAULT 0,
+    humans INTEGER NOT NULL DEFAULT 0,
+    badges INTEGER NOT NULL DEFAULT 0,
+    violations INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (camera, kind, hour)
+);
+"""
+
+UPSERT_HOURLY = """
+INSERT INTO hourly_counts (camera, kind, hour, events, humans, badges, violations)
+VALUES (?, ?, ?, 1, ?, ?, ?)
+ON CONFLICT (camera, kind, hour) DO UPDATE SET
+    events = events + 1,
+    humans = humans + excluded.humans,
+    badges = badges + excluded.badges,
+    violations = violations + excluded.violations
+"""
+
+def summarize_detections(detections):
+    """
+    Trả về (human_count, badge_count, compliant) từ detections dict.
+    compliant = None nếu không đủ thông tin (chỉ chạy một model).
+    """
+    if "humans" in detections or "badges" in detections:
+        human_count = detections.get("humans", {}).get("count", 0)
+        badge_count = detections.get("badges", {}).get("count", 0)
+        return human_count, badge_count, int(badge_count >= human_count)
+    return None
+
+class EventStore:
+    """
+    Append-only detection store.
+    `record()` chỉ đẩy vào queue (không block); thread nền ghi theo batch.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH, mode="change", retention_days=30,
+                 batch_size=200, flush_interval=1.0, max_queue=10000, enabled=True):
+        self.path = os.path.abspath(path)
+        self.mode = mode
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._last = {}
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.dropped = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv("EVENT_STORE_PATH", DEFAULT_DB_PATH),
+            mode=os.getenv("EVENT_STORE_MODE", "change"),
+            retention_days=float(os.getenv("EVENT_STORE_RETENTION_DAYS", "30")),
+            batch_size=int(os.getenv("EVENT_STORE_BATCH_SIZE", "200")),
+            flush_interval=float(os.getenv("EVENT_STORE_FLUSH_INTERVAL", "1.0")),
+            enabled=os.getenv("EVENT_STORE_ENABLED", "1") != "0"
+        )
+
+    # -------------------- connections --------------------
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_db(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        # auto_vacuum phải được set trước khi tạo bảng
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.close()
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.commit()
+        return conn
+
+    # -------------------- write path --------------------
+
+    def record(self, camera, kind, detections, ts=None):
+        """
+        Ghi nhận detections của một frame (non-blocking).
+        Với mode="change", bỏ qua frame nếu detections không đổi so với lần trước
+        của cùng camera + kind.
+        """
+        if not self.enabled:
+            return
+
+        key = (str(camera), kind)
+        if self.mode == "change":
+            if not detections_changed(self._last.get(key), detections):
+                return
+            self._last[key] = detections
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((ts or time.time(), key[0], kind, detections))
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._writer_loop, name="event-store-writer", daemon=True)
+                self._thread.start()
+
+    def _writer_loop(self):
+        conn = self._init_db()
+        print(f"Event store opened: {self.path}")
+        last_compact = 0.0
+
+        while not self._stop.is_set() or not self._queue.empty():
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self._write_batch(conn, batch)
+                except sqlite3.Error as e:
+                    print(f"Event store write error: {e}")
+
+            if time.time() - last_compact >= COMPACT_INTERVAL:
+                last_compact = time.time()
+                try:
+                    self.compact(conn)
+                except sqlite3.Error as e:
+                    print(f"Event store compaction error: {e}")
+
+        conn.close()
+
+    def _write_batch(self, conn, batch):
+        rows = []
+        hourly = []
+        for ts, camera, kind, detections in batch:
+            summary = summarize_detections(detections)
+            if summary is None:
+                count = detections.get("count", len(detections.get("boxes_xyxy", [])))
+                human_count, badge_count, compliant = (count, 0, None) if kind == "human" else (0, count, None)
+            else:
+                human_count, badge_count, compliant = summary
+
+            rows.append((ts, camera, kind, human_count, badge_count, compliant,
+                         json.dumps(detections, separators=(",", ":"))))
+            hourly.append((camera, kind, int(ts // 3600) * 3600, human_count, badge_count,
+                           1 if compliant == 0 else 0))
+
+        with conn:
+            conn.executemany(
+                "INSERT INTO events (ts, camera, kind, human_count, badge_count, compliant, detections) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.executemany(UPSERT_HOURLY, hourly)
+
+    def compact(self, conn=None):
+        """Xoá dữ liệu quá hạn retention và thu hồi dung lượng file"""
+        own = conn is None
+        conn = conn or self._connect()
+        try:
+            if self.retention_days and self.retention_days > 0:
+                cutoff = time.time() - self.retention_days * 86400
+                with conn:
+                    deleted = conn.execute("DELETE FROM events WHERE ts < ?", (cutoff,)).rowcount
+                    conn.execute("DELETE FROM hourly_counts WHERE hour < ?", (int(cutoff // 3600) * 3600,))
+                if deleted:
+                    print(f"Event store retention: deleted {deleted} events")
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            if own:
+                conn.close()
+
+    def close(self):
+        """Flush queue và dừng writer thread"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=10)
+        self._thread = None
+
+    # -------------------- read path --------------------
+
+    def query(self, start, end, camera=None, kind=None, compliant=None, limit=1000):
+        """Lấy events trong khoảng thời gian [start, end)"""
+        if not os.path.exists(self.path):
+            return []
+
+        sql = "SELECT ts, camera, kind, human_count, badge_count, compliant, detections FROM events WHERE ts >= ? AND ts < ?"
+        params = [start, end]
+        if camera is not None:
+            sql += " AND camera = ?"
+            params.append(str(camera))
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        if compliant is not None:
+            sql += " AND compliant = ?"
+            params.append(int(compliant))
+        sql += " ORDER BY ts LIMIT ?"
+        params.append(limit)
+
+        conn = self._connect()
+        try:
+            return [{
+                "timestamp": ts,
+                "camera": cam,
+                "kind": k,
+                "human_count": humans,
+                "badge_count": badges,
+                "compliant": None if comp is None else bool(comp),
+                "detections": json.loads(dets)
+            } for ts, cam, k, humans, badges, comp, dets in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def hourly(self, start, end, camera=None, kind=None):
+        """Thống kê theo giờ (đọc từ bảng hourly_counts)"""
+        if not os.path.exists(self.path):
+            return []
+
+        sql = ("SELECT hour, SUM(events), SUM(humans), SUM(badges), SUM(violations) "
+               "FROM hourly_counts WHERE hour >= ? AND hour < ?")
+        params = [int(start // 3600) * 3600, end]
+        if camera is not None:
+            sql += " AND camera = ?"
+            params.append(str(camera))
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " GROUP BY hour ORDER BY hour"
+
+        conn = self._connect()
+        try:
+            return [{
+                "hour": hour,
+                "events": events,
+                "humans": humans,
+                "badges": badges,
+                "violations": violations
+            } for hour, events, humans, badges, violations in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "mode": self.mode,
+            "queued": self._queue.qsize(),
+            "dropped": self.dropped,
+            "retention_days": self.retention_days
+        }
+
+# Global event store
+event_store = EventStore.from_env()
@@ -0,0 +1,336 @@
+import json
+import queue
+import threading
+import time
+
+# ============================================================
+# DETECTION EVENT STREAM HELPERS
+# ============================================================
+# Các hàm tiện ích để phát detection metadata (không có ảnh) qua
+# Server-Sent Events hoặc NDJSON cho dashboard / access-control.
+#
+# Mỗi (source, kind, confidence) có một detection loop (thread) đọc frame mới
+# nhất từ capture thread của source, chạy model và publish kết quả vào
+# `detection_hub`. MJPEG viewer và event client chỉ là subscriber (fan-out):
+# client chậm chỉ bỏ item trong queue của chính nó, không chặn loop hay camera.
+# Event client human / badge dùng lại combined loop đang chạy của cùng source
+# (nhóm "humans" / "badges") thay vì chạy thêm một loop nữa.
+# seq / timestamp của event là số thứ tự và thời điểm capture của frame (giống
+# nhau giữa các client, seq bị nhảy = frame đã bị bỏ qua).
+
+EVENT_FORMATS = ("sse", "ndjson")
+EVENT_MODES = ("frame", "change")
+
+def _box_lists(detections):
+    """
+    Lấy danh sách boxes từ detections dict (hỗ trợ cả dạng đơn và combined)
+    """
+    if "humans" in detections or "badges" in detections:
+        return [
+            detections.get("humans", {}).get("boxes", []),
+            detections.get("badges", {}).get("boxes", []),
+        ]
+    return [detections.get("boxes_xyxy", [])]
+
+def detections_changed(previous, current, tolerance=10.0):
+    """
+    So sánh hai detections dict.
+    Trả về True nếu số lượng object thay đổi hoặc có box dịch chuyển quá `tolerance` pixel.
+    """
+    if previous is None:
+        return True
+
+    previous_boxes = _box_lists(previous)
+    current_boxes = _box_lists(current)
+    for old_group, new_group in zip(previous_boxes, current_boxes):
+        if len(old_group) != len(new_group):
+            return True
+        for old_box, new_box in zip(old_group, new_group):
+            if any(abs(a - b) > tolerance for a, b in zip(old_box, new_box)):
+                return True
+    return False
+
+def format_event(event, fmt="sse"):
+    """
+    Encode một event dict thành bytes theo định dạng SSE hoặc NDJSON
+    """
+    payload = json.dumps(event, separators=(",", ":"))
+    if fmt == "ndjson":
+        return (payload + "\n").encode("utf-8")
+    return f"id: {event['seq']}\nevent: detections\ndata: {payload}\n\n".encode("utf-8")
+
+def keepalive(fmt="sse"):
+    """Heartbeat để giữ kết nối khi không có thay đổi (mode=change)"""
+    if fmt == "ndjson":
+        return b"\n"
+    return b": keepalive\n\n"
+
+def detection_events(detection_stream, fmt="sse", mode="frame", tolerance=10.0, heartbeat=15.0):
+    """
+    Chuyển generator item của detection loop ({"seq", "timestamp", "detections"})
+    thành chuỗi event bytes. seq / timestamp lấy từ frame đã capture.
+
+    - **mode="frame"**: phát một event cho mỗi frame
+    - **mode="change"**: chỉ phát khi detections thay đổi, kèm heartbeat định kỳ
+    """
+    previous = None
+    last_sent = time.time()
+
+    for item in detection_stream:
+        detections = item["detections"]
+        now = time.time()
+
+        if mode == "change" and not detections_changed(previous, detections, tolerance):
+            if now - last_sent >= heartbeat:
+                last_sent = now
+                yield keepalive(fmt)
+            continue
+
+        previous = detections
+        last_sent = now
+        yield format_event({
+            "seq": item["seq"],
+            "timestamp": item["timestamp"],
+            "detections": detections
+        }, fmt)
+
+# ============================================================
+# DETECTION FAN-OUT (CAPTURE LOOP -> EVENT SUBSCRIBERS)
+# ============================================================
+
+SUBSCRIBER_QUEUE_SIZE = 30
+
+def _put_latest(q, item):
+    """Đẩy item vào queue, bỏ item cũ nhất nếu subscriber đọc chậm"""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+def filter_detections(detections, confidence):
+    """Bỏ các box có confidence < threshold (dạng đơn và combined)"""
+    if "humans" in detections or "badges" in detections:
+        filtered = {}
+        for group in ("humans", "badges"):
+            data = detections.get(group, {})
+            keep = [i for i, c in enumerate(data.get("confidence", [])) if c >= confidence]
+            filtered[group] = {
+                "count": len(keep),
+                "boxes": [data["boxes"][i] for i in keep],
+                "confidence": [data["confidence"][i] for i in keep]
+            }
+            if "classes" in data:
+                filtered[group]["classes"] = [data["classes"][i] for i in keep]
+        filtered["total_count"] = filtered["humans"]["count"] + filtered["badges"]["count"]
+        return filtered
+
+    keep = [i for i, c in enumerate(detections.get("confidence", [])) if c >= confidence]
+    return {
+        "boxes_xyxy": [detections["boxes_xyxy"][i] for i in keep],
+        "classes": [detections["classes"][i] for i in keep],
+        "confidence": [detections["confidence"][i] for i in keep],
+        "count": len(keep)
+    }
+
+# Kind của loop đơn -> nhóm tương ứng trong detections của combined loop
+COMBINED_GROUPS = {"human": "humans", "badge": "badges"}
+
+def combined_group(detections, group):
+    """Một nhóm của combined detections ở dạng loop đơn (boxes_xyxy, classes, confidence, count)"""
+    data = detections.get(group, {})
+    boxes = data.get("boxes", [])
+    return {
+        "boxes_xyxy": boxes,
+        "classes": data.get("classes", [0.0] * len(boxes)),
+        "confidence": data.get("confidence", []),
+        "count": len(boxes)
+    }
+
+class Subscription:
+    """
+    Một consumer của detection loop. Queue riêng: event client giữ tối đa
+    SUBSCRIBER_QUEUE_SIZE item, MJPEG viewer (maxsize=1) chỉ giữ item mới nhất.
+    Item: {"seq", "timestamp", "detections", "frame"}; None = loop đã dừng.
+    group: subscriber human / badge gắn vào combined loop chỉ nhận nhóm của mình.
+    """
+
+    def __init__(self, channel, confidence, maxsize=SUBSCRIBER_QUEUE_SIZE, frames=False, max_fps=None, group=None):
+        self.channel = channel
+        self.confidence = confidence
+        self.frames = frames
+        self.max_fps = max_fps
+        self.group = group
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def get(self, timeout):
+        """Item tiếp theo (raise queue.Empty nếu quá timeout), lọc theo confidence của subscriber"""
+        item = self.queue.get(timeout=timeout)
+        if item is None:
+            return None
+        detections = item["detections"]
+        if self.group is not None:
+            detections = combined_group(detections, self.group)
+        if self.confidence > self.channel.confidence:
+            detections = filter_detections(detections, self.confidence)
+        if detections is not item["detections"]:
+            item = dict(item, detections=detections)
+        return item
+
+    def close(self):
+        self.channel.unsubscribe(self)
+
+class DetectionChannel:
+    """Kết quả của một detection loop, phát tới các subscriber queue"""
+
+    def __init__(self, hub, key, confidence):
+        self.hub = hub
+        self.key = key
+        self.confidence = confidence
+        self.closed = False
+        self.published = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def publish(self, item):
+        with self._lock:
+            self.published += 1
+            for sub in self._subscribers:
+                _put_latest(sub.queue, item)
+
+    def subscribe(self, confidence, **kwargs):
+        sub = Subscription(self, confidence, **kwargs)
+        with self._lock:
+            if self.closed:
+                _put_latest(sub.queue, None)
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            for sub in self._subscribers:
+                _put_latest(sub.queue, None)
+        self.hub._remove(self)
+
+    @property
+    def subscribers(self):
+        return len(self._subscribers)
+
+    @property
+    def wants_frames(self):
+        """Có MJPEG viewer: loop cần vẽ box lên frame"""
+        with self._lock:
+            return any(sub.frames for sub in self._subscribers)
+
+    @property
+    def max_fps(self):
+        """FPS cần xử lý: None (mọi frame) nếu có subscriber không giới hạn FPS"""
+        with self._lock:
+            limits = [sub.max_fps for sub in self._subscribers]
+        if not limits or None in limits:
+            return None
+        return max(limits)
+
+class DetectionHub:
+    """Registry detection loop đang chạy theo (source, kind, confidence)"""
+
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def attach(self, source, kind, confidence, run, share=False, **kwargs):
+        """
+        Subscribe vào detection loop (source, kind, confidence), chạy `run(channel)` trên
+        thread mới nếu chưa có loop. share=True: dùng lại loop cùng kind có confidence
+        thấp hơn, hoặc (human / badge) combined loop của cùng source (event client,
+        detections được lọc lại theo confidence của client).
+        """
+        with self._lock:
+            key = (str(source), kind, round(confidence, 3))
+            channel = self._channels.get(key)
+            if channel is None and share:
+                channel = self._shared(key, confidence)
+            started = channel is None
+            if started:
+                channel = DetectionChannel(self, key, confidence)
+                self._channels[key] = channel
+            if channel.key[1] != kind:
+                kwargs["group"] = COMBINED_GROUPS[kind]
+            sub = channel.subscribe(confidence, **kwargs)
+
+        if started:
+            threading.Thread(target=self._run, args=(channel, run),
+                             name=f"detect-{key[1]}-{key[0]}", daemon=True).start()
+        return sub
+
+    def _shared(self, key, confidence):
+        """Loop đang chạy có thể dùng chung: cùng kind trước, sau đó combined loop (gọi trong lock)"""
+        kinds = [key[1]]
+        if key[1] in COMBINED_GROUPS:
+            kinds.append("combined")
+        for kind in kinds:
+            shared = [c for c in self._channels.values()
+                      if c.key[:2] == (key[0], kind) and c.confidence <= confidence]
+            if shared:
+                return max(shared, key=lambda c: c.confidence)
+        return None
+
+    def _run(self, channel, run):
+        try:
+            run(channel)
+        except Exception as e:
+            print(f"Detection loop {channel.key} error: {e}")
+        finally:
+            channel.close()
+
+    def active(self, channel):
+        """
+        Loop còn subscriber không. Nếu không: gỡ channel khỏi hub ngay trong lock
+        (client mới sẽ mở loop mới thay vì subscribe vào loop sắp dừng)
+        """
+        with self._lock:
+            if channel.subscribers:
+                return True
+            if self._channels.get(channel.key) is channel:
+                del self._channels[channel.key]
+            return False
+
+    def _remove(self, channel):
+        with self._lock:
+            if self._channels.get(channel.key) is channel:
+                del self._channels[channel.key]
+
+    def stats(self):
+        with self._lock:
+            return [
+                {"source": key[0], "kind": key[1], "confidence": channel.confidence,
+                 "subscribers": channel.subscribers, "published": channel.published}
+                for key, channel in self._channels.items()
+            ]
+
+def shared_detections(subscription, poll=1.0):
+    """Generator item từ subscription của detection loop, dừng khi loop dừng"""
+    try:
+        while True:
+            try:
+                item = subscription.get(timeout=poll)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            yield item
+    finally:
+        subscription.close()
+
+# Global instance
+detection_hub = DetectionHub()
@@ -1,55 +1,66 @@
-# ============================
-# LOAD MODEL SAFELY - PATCH TORCH FIRST
-# ============================
-# Monkey patch torch.load để tương thích với PyTorch 2.6
-# PHẢI PATCH TRƯỚC KHI IMPORT ULTRALYTICS
-import torch
-
-_original_torch_load = torch.load
-
-def _patched_torch_load(f, *args, **kwargs):
-    """Wrapper để set weights_only=False cho YOLO models"""
-    # Nếu không có weights_only trong kwargs, set mặc định là False
-    if 'weights_only' not in kwargs:
-        kwargs['weights_only'] = False
-    return _original_torch_load(f, *args, **kwargs)
-
-# Apply patch
-torch.load = _patched_torch_load
-
-# ============================
-# NOW IMPORT ULTRALYTICS
-# ============================
-import ultralytics
 import os
-from ultralytics import YOLO
 from PIL import Image
 import io
 import numpy as np
 import cv2
 import threading
-import uuid
 import time
+import json
 
-# Check for GPU
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-print(f"Using device: {device}")
+from api.event_store import event_store
+from api.events import detection_hub, SUBSCRIBER_QUEUE_SIZE
+from api.recorder import clip_recorder
+from api.hard_examples import hard_example_sampler
+from api.models import ModelHandle, LAZY_MODELS, load_models
+from api.capture import CaptureSettings, CaptureWatchdog, SourceHealth, SourceReader
+from api.scheduler import scheduler, DeadlineExceeded
+from api.snapshots import snapshot_cache
 
-# Load YOLO model for human detection
-model_path = os.path.join(os.path.dirname(__file__), "..", "models", "yolov8n.pt")
-model = YOLO(model_path)
-model.to(device)
+# ============================================================
+# MODELS
+# ============================================================
+def load_model_manifest(weights_path):
+    """
+    Đọc manifest (<weights>.json) do badge_detection/train.py --publish tạo ra:
+    imgsz, classes, metrics, exports, latency CPU.
+    Trả về {} nếu không có manifest.
+    """
+    manifest_path = os.path.splitext(weights_path)[0] + ".json"
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Cannot read model manifest {manifest_path}: {e}")
+        return {}
 
-# Load badge detection model
+model_path = os.path.join(os.path.dirname(__file__), "..", "models", "yolov8n.pt")
 badge_model_path = os.path.join(os.path.dirname(__file__), "..", "models", "badge_detect.pt")
-badge_model = YOLO(badge_model_path)
-badge_model.to(device)
-print(f"Badge detection model loaded from: {badge_model_path}")
+
+badge_model_manifest = load_model_manifest(badge_model_path)
+if badge_model_manifest:
+    print(f"Badge model manifest: imgsz={badge_model_manifest.get('imgsz')}, "
+          f"latency={badge_model_manifest.get('latency', {}).get('pt')}")
+
+# Model cho human detection và badge detection.
+# Backend (yolo / onnx / stub) và lazy loading cấu hình trong api/models.py
+model = ModelHandle("human", model_path, {0: "person"}, {"count": 2})
+badge_model = ModelHandle("badge", badge_model_path, {0: "badge"}, {"count": 1, "period": 45},
+                          manifest=badge_model_manifest)
+
+if not LAZY_MODELS:
+    load_models([model, badge_model])
 
 # ============================================================
 # CAMERA MANAGER
 # ============================================================
 class CameraManager:
+    """
+    Capture source -> SourceReader (api/capture.py). Mỗi source có một capture
+    thread riêng; detection loop và snapshot chỉ lấy frame mới nhất từ reader,
+    nên nhiều stream / event client cùng một camera không chiếm quyền nhau.
+    """
     _instance = None
     _lock = threading.Lock()
 
@@ -58,80 +69,114 @@ class CameraManager:
             with cls._lock:
                 if cls._instance is None:
                     cls._instance = super(CameraManager, cls).__new__(cls)
-                    cls._instance.cap = None
-                    cls._instance.current_source = None
-                    cls._instance.active_stream_id = None
+                    cls._instance.readers = {}
                     cls._instance.camera_lock = threading.Lock()
+                    cls._instance.reaper = None
+                    cls._instance.settings = CaptureSettings()
+                    cls._instance.health = {}
+                    cls._instance.watchdog = CaptureWatchdog(cls._instance.readers, cls._instance.settings)
         return cls._instance
 
-    def start_stream(self, source):
-        """
-        Start a new stream. If source is different, release old camera and open new one.
-        Returns a unique stream_id.
-        """
+    def _source_health(self, source):
+        key = str(source)
+        if key not in self.health:
+            self.health[key] = SourceHealth(key)
+        return self.health[key]
+
+    def _reader(self, source):
+        """Reader đang chạy của source, mở mới nếu chưa có (phải giữ camera_lock)"""
+        key = str(source)
+        reader = self.readers.get(key)
+        if reader is None or reader.stopped:
+            print(f"Opening camera source: {source}")
+            reader = SourceReader(source, self.settings, self._source_health(source))
+            if not reader.start():
+                raise ValueError(f"Cannot open camera source: {source}")
+            self.readers[key] = reader
+            self.watchdog.ensure_started()
+        return reader
+
+    def acquire(self, source):
+        """Reader của source cho một detection loop (giữ capture mở đến khi release)"""
         with self.camera_lock:
-            new_stream_id = str(uuid.uuid4())
-            self.active_stream_id = new_stream_id
-            
-            # Check if we need to re-open camera
-            # Re-open if: source changed OR camera is not open
-            if self.current_source != source or self.cap is None or not self.cap.isOpened():
-                if self.cap is not None:
-                    self.cap.release()
-                
-                print(f"Opening camera source: {source}")
-                self.cap = cv2.VideoCapture(source)
-                self.current_source = source
-                
-                if not self.cap.isOpened():
-                    raise ValueError(f"Cannot open camera source: {source}")
-            else:
-                print(f"Reusing existing camera source: {source}")
-            
-            return new_stream_id
+            reader = self._reader(source)
+            reader.users += 1
+            return reader
 
-    def get_frame(self, stream_id):
+    def release(self, reader):
         """
-        Get frame for a specific stream_id.
-        Returns None if stream_id is not active or camera error.
+        Detection loop dừng. Capture được giữ mở (warm) cho snapshot và đóng sau
+        CAMERA_IDLE_TIMEOUT giây không dùng (0 = đóng ngay khi không còn loop nào)
         """
-        # Check if this stream is still the active one
-        if stream_id != self.active_stream_id:
-            return None
-            
-        if self.cap is None or not self.cap.isOpened():
-            return None
-
-        ret, frame = self.cap.read()
-        if not ret:
-            return None
-        return frame
-
-    def stop_stream(self, stream_id):
+        with self.camera_lock:
+            reader.users -= 1
+            if reader.users > 0 or self.readers.get(str(reader.source)) is not reader:
+                return
+            if self.settings.idle_timeout <= 0:
+                print(f"Camera source {reader.source} no longer streamed. Releasing camera.")
+                self._release(reader.source)
+            else:
+                print(f"Camera source {reader.source} no longer streamed. Keeping camera warm for {self.settings.idle_timeout}s.")
+                self._ensure_reaper()
+
+    def _release(self, source):
+        """Dừng capture thread của source (phải giữ camera_lock)"""
+        reader = self.readers.pop(str(source), None)
+        if reader is not None:
+            reader.stop()
+
+    def _ensure_reaper(self):
+        """Thread nền đóng capture warm sau CAMERA_IDLE_TIMEOUT giây không dùng"""
+        if self.reaper is not None:
+            return
+        self.reaper = threading.Thread(target=self._reap_idle, name="camera-idle-reaper", daemon=True)
+        self.reaper.start()
+
+    def _reap_idle(self):
+        while True:
+            time.sleep(1.0)
+            with self.camera_lock:
+                now = time.time()
+                for key, reader in list(self.readers.items()):
+                    if reader.users == 0 and now - reader.last_used > self.settings.idle_timeout:
+                        print(f"Camera source {key} idle for {self.settings.idle_timeout}s. Releasing camera.")
+                        self._release(key)
+
+    def snapshot(self, source):
         """
-        Stop a stream. If it's the active stream, release the camera.
+        Frame mới nhất của source, không chiếm quyền stream đang chạy:
+        - source đang mở (stream hoặc warm): dùng frame capture thread vừa đọc
+        - chưa mở: mở và giữ warm đến CAMERA_IDLE_TIMEOUT
+        Returns: (frame, captured_at)
         """
         with self.camera_lock:
-            if self.active_stream_id == stream_id:
-                print(f"Stopping active stream: {stream_id}. Releasing camera.")
-                if self.cap is not None:
-                    self.cap.release()
-                    self.cap = None
-                self.current_source = None
-                self.active_stream_id = None
-            else:
-                print(f"Stream {stream_id} is no longer active. Ignoring stop request.")
+            reader = self._reader(source)
+            self._ensure_reaper()
+        # Device vừa mở có thể cần một lúc mới có frame đầu tiên
+        item = reader.latest(self.settings.stall_timeout, self.settings.stall_timeout)
+        if item is None:
+            raise ValueError("Cannot read frame from camera")
+        _, frame, captured_at = item
+        return frame, captured_at
 
     def force_release(self):
         """Force release camera resources"""
         with self.camera_lock:
-            if self.cap is not None:
-                self.cap.release()
-                self.cap = None
-            self.current_source = None
-            self.active_stream_id = None
+            for key in list(self.readers):
+                self._release(key)
             print("Camera force released")
 
+    def health_report(self):
+        """Sức khỏe của tất cả source đã từng mở (+ số giây từ lần cuối được đọc)"""
+        report = []
+        now = time.time()
+        for key, health in list(self.health.items()):
+            entry = health.to_dict()
+            reader = self.readers.get(key)
+            entry["unused_s"] = round(now - reader.last_used, 1) if reader is not None else None
+            report.append(entry)
+        return report
+
 # Initialize global camera manager
 camera_manager = CameraManager()
 
@@ -148,20 +193,110 @@ def check_image_bytes(image_bytes: bytes) -> Image.Image:
     except Exception as e:
         raise ValueError(f"Invalid image data: {str(e)}")
 
+def encode_frame(frame):
+    """
+    Encode frame (BGR) thành JPEG bytes.
+    Trả về None nếu encode lỗi.
+    """
+    ret, buffer = cv2.imencode('.jpg', frame)
+    if not ret:
+        return None
+    return buffer.tobytes()
+
+def encode_snapshot(result):
+    """Vẽ box của results[0] lên frame gốc và encode JPEG cho snapshot"""
+    frame_bytes = encode_frame(result.plot())
+    if frame_bytes is None:
+        raise ValueError("Cannot encode frame to JPEG")
+    return frame_bytes
+
+def cached_snapshot(camera_source, kind, confidence_threshold):
+    """
+    Snapshot từ kết quả live stream còn mới (SNAPSHOT_MAX_AGE_MS), không chạy model.
+    Returns: (frame_bytes, detections, {"cached": True, "age_ms": ...}) hoặc None
+    """
+    cached = snapshot_cache.get(camera_source, kind, confidence_threshold)
+    if cached is None:
+        return None
+    result, detections, age = cached
+    return encode_snapshot(result), detections, {"cached": True, "age_ms": round(age * 1000, 1)}
+
+def boxes_to_detections(boxes):
+    """Detections dict dạng snapshot (boxes_xyxy, classes, confidence, count)"""
+    return {
+        "boxes_xyxy": boxes.xyxy.cpu().numpy().tolist() if len(boxes) > 0 else [],
+        "classes": boxes.cls.cpu().numpy().tolist() if len(boxes) > 0 else [],
+        "confidence": boxes.conf.cpu().numpy().tolist() if len(boxes) > 0 else [],
+        "count": len(boxes)
+    }
+
+def _badge_stream_conf(confidence_threshold):
+    """
+    Confidence chạy badge model trong detection loop: hạ xuống SAMPLER_CONF_LOW khi sampler
+    bật để sampler thấy cả badge mơ hồ dưới threshold (kết quả được lọc lại bằng _above)
+    """
+    if hard_example_sampler.enabled:
+        return min(hard_example_sampler.conf_low, confidence_threshold)
+    return confidence_threshold
+
+def _above(result, confidence_threshold):
+    """Result chỉ giữ box có confidence >= threshold (output, event, store, snapshot cache)"""
+    boxes = result.boxes
+    if len(boxes) == 0:
+        return result
+    conf = boxes.conf.cpu().numpy()
+    if (conf >= confidence_threshold).all():
+        return result
+    return result[np.flatnonzero(conf >= confidence_threshold).tolist()]
+
+def _live_frames(channel, reader):
+    """
+    Frame cho detection loop: frame mới nhất của capture thread, giới hạn theo FPS
+    lớn nhất mà subscriber cần. Dừng khi không còn subscriber hoặc capture thread dừng.
+    Yields: (seq, frame, captured_at)
+    """
+    seq = 0
+    last = 0.0
+    while detection_hub.active(channel):
+        item = reader.next_frame(seq, 1.0)
+        if item is None:
+            if reader.stopped:
+                print(f"Cannot read frame from camera source {reader.source}")
+                return
+            continue
+        seq, frame, captured_at = item
+        max_fps = channel.max_fps
+        if max_fps and captured_at - last < 1.0 / max_fps:
+            continue
+        last = captured_at
+        yield seq, frame, captured_at
+
+def _subscribe(kind, loop, camera_source, confidence_threshold, frames, max_fps, qos, share):
+    """Subscribe vào detection loop (source, kind, confidence), chạy `loop` nếu chưa có"""
+    return detection_hub.attach(
+        camera_source, kind, confidence_threshold,
+        lambda channel: loop(channel, camera_source, confidence_threshold, qos),
+        share=share, maxsize=1 if frames else SUBSCRIBER_QUEUE_SIZE, frames=frames, max_fps=max_fps
+    )
+
 # ============================================================
 # HUMAN DETECTION FUNCTIONS
 # ============================================================
 
 # Function 01: Detect Human By Image
-def detect_human_by_image(image_bytes: bytes):
+def detect_human_by_image(image_bytes: bytes, qos="interactive", deadline=None):
     """
     Detect humans in an uploaded image
+
+    - **qos** / **deadline**: priority class và deadline (time.time()) khi chờ slot inference
+      (qos=None: endpoint đã giữ slot qua scheduler.async_slot)
     """
     img = check_image_bytes(image_bytes)
     img_np = np.array(img)
 
     # Chạy YOLO detection - chỉ detect người (class 0)
-    results = model(img_np, classes=[0])
+    with scheduler.slot(qos, deadline):
+        results = model(img_np, classes=[0])
 
     annotated = results[0].plot() # numpy array
 
@@ -183,101 +318,86 @@ def detect_human_by_image(image_bytes: bytes):
     }
 
 # Function 02: Detect Human From Real-time Camera
-def detect_human_from_camera(camera_source=0, confidence_threshold=0.5):
-    """
-    Detect humans from real-time camera stream using CameraManager
-    """
-    stream_id = camera_manager.start_stream(camera_source)
-    
+def _human_loop(channel, camera_source, confidence_threshold, qos):
+    """Detection loop: human model trên frame mới nhất của camera, publish vào channel"""
+    reader = camera_manager.acquire(camera_source)
     try:
-        while True:
-            frame = camera_manager.get_frame(stream_id)
-            
-            if frame is None:
-                # Check if stream was preempted
-                if stream_id != camera_manager.active_stream_id:
-                    print("Stream preempted by new request")
-                    break
-                print("Cannot read frame from camera")
-                break
-            
+        for seq, frame, captured_at in _live_frames(channel, reader):
             # Chạy YOLO detection - chỉ detect người (class 0)
-            results = model(frame, conf=confidence_threshold, classes=[0])
-            
-            annotated_frame = results[0].plot()
-            
-            ret, buffer = cv2.imencode('.jpg', annotated_frame)
-            if not ret:
+            try:
+                with scheduler.slot(qos):
+                    results = model(frame, conf=confidence_threshold, classes=[0])
+            except DeadlineExceeded:
                 continue
-                
-            frame_bytes = buffer.tobytes()
             
             # Lấy detection data - chỉ người (class 0)
-            boxes = results[0].boxes
-            detections = {
-                "boxes_xyxy": boxes.xyxy.cpu().numpy().tolist() if len(boxes) > 0 else [],
-                "classes": boxes.cls.cpu().numpy().tolist() if len(boxes) > 0 else [],
-                "confidence": boxes.conf.cpu().numpy().tolist() if len(boxes) > 0 else [],
-                "count": len(boxes)
-            }
-            
-            yield frame_bytes, detections
+            detections = boxes_to_detections(results[0].boxes)
             
+            event_store.record(camera_source, "human", detections)
+            snapshot_cache.put(camera_source, "human", results[0], detections, confidence_threshold)
+            channel.publish({
+                "seq": seq,
+                "timestamp": captured_at,
+                "detections": detections,
+                "frame": results[0].plot() if channel.wants_frames else None
+            })
     finally:
-        # Release camera if this was the active stream
-        camera_manager.stop_stream(stream_id)
+        camera_manager.release(reader)
+
+def detect_human_from_camera(camera_source=0, confidence_threshold=0.5, frames=True, max_fps=None, qos="live",
+                             share=False):
+    """
+    Subscribe vào human detection loop của camera (chạy loop nếu chưa có).
+    Mọi viewer / event client cùng (source, confidence) dùng chung một loop.
+
+    - **frames**: True cho MJPEG viewer (loop vẽ box lên frame), False cho event client
+    - **max_fps**: FPS viewer cần (None = mọi frame)
+    - **qos**: priority class của loop; frame chờ slot quá deadline bị bỏ để đọc frame mới hơn
+    - **share**: dùng lại loop có confidence thấp hơn (event client)
+
+    Returns: Subscription (api/events.py), item = {"seq", "timestamp", "detections", "frame"}
+    """
+    return _subscribe("human", _human_loop, camera_source, confidence_threshold, frames, max_fps, qos, share)
 
 # Function 03: Detect Human From Camera (Single Frame)
-def detect_human_from_camera_single_frame(camera_source=0, confidence_threshold=0.5):
+def detect_human_from_camera_single_frame(camera_source=0, confidence_threshold=0.5, qos="interactive", deadline=None,
+                                          snapshot=None):
     """
     Capture single frame from camera and detect humans
+
+    Dùng capture đang mở sẵn (không chiếm quyền live stream). Nếu live stream vừa
+    detect trong SNAPSHOT_MAX_AGE_MS thì dùng lại kết quả, không chạy model.
+
+    - **snapshot**: (frame, captured_at) đã đọc sẵn; endpoint đọc frame và chờ slot
+      (qos=None) trước khi gọi hàm này
+    Returns: (frame_bytes, detections, {"cached": bool, "age_ms": tuổi của frame})
     """
-    # For single frame, we start and immediately stop
-    stream_id = camera_manager.start_stream(camera_source)
+    if snapshot is None:
+        cached = cached_snapshot(camera_source, "human", confidence_threshold)
+        if cached is not None:
+            return cached
+        snapshot = camera_manager.snapshot(camera_source)
+    frame, captured_at = snapshot
     
-    try:
-        # Try to get a valid frame (retry a few times if needed for warmup)
-        frame = None
-        for _ in range(5):
-            frame = camera_manager.get_frame(stream_id)
-            if frame is not None:
-                break
-            time.sleep(0.1)
-            
-        if frame is None:
-            raise ValueError("Cannot read frame from camera")
-        
-        # Chạy YOLO detection - chỉ detect người (class 0)
+    # Chạy YOLO detection - chỉ detect người (class 0)
+    with scheduler.slot(qos, deadline):
         results = model(frame, conf=confidence_threshold, classes=[0])
-        
-        annotated_frame = results[0].plot()
-        
-        ret, buffer = cv2.imencode('.jpg', annotated_frame)
-        if not ret:
-            raise ValueError("Cannot encode frame to JPEG")
-        
-        frame_bytes = buffer.tobytes()
-        
-        # Lấy detection data - chỉ người (class 0)
-        boxes = results[0].boxes
-        detections = {
-            "boxes_xyxy": boxes.xyxy.cpu().numpy().tolist() if len(boxes) > 0 else [],
-            "classes": boxes.cls.cpu().numpy().tolist() if len(boxes) > 0 else [],
-            "confidence": boxes.conf.cpu().numpy().tolist() if len(boxes) > 0 else [],
-            "count": len(boxes)
-        }
-        
-        return frame_bytes, detections
-        
-    finally:
-        camera_manager.stop_stream(stream_id)
+    
+    # Lấy detection data - chỉ người (class 0)
+    detections = boxes_to_detections(results[0].boxes)
+    
+    event_store.record(camera_source, "human", detections)
+    snapshot_cache.put(camera_source, "human", results[0], detections, confidence_threshold)
+    
+    age_ms = round((time.time() - captured_at) * 1000, 1)
+    return encode_snapshot(results[0]), detections, {"cached": False, "age_ms": age_ms}
 
 # ============================================================
 # BADGE DETECTION FUNCTIONS
 # ============================================================
 
 # Function 04: Detect Badge By Image
-def detect_badge_by_image(image_bytes: bytes):
+def detect_badge_by_image(image_bytes: bytes, qos="interactive", deadline=None):
     """
     Detect badges in an uploaded image using trained badge model
     """
@@ -285,7 +405,8 @@ def detect_badge_by_image(image_bytes: bytes):
     img_np = np.array(img)
 
     # Chạy badge detection - detect tất cả classes từ trained model
-    results = badge_model(img_np)
+    with scheduler.slot(qos, deadline):
+        results = badge_model(img_np)
 
     annotated = results[0].plot() # numpy array
 
@@ -300,6 +421,13 @@ def detect_badge_by_image(image_bytes: bytes):
     classes = boxes.cls.cpu().numpy().tolist() if len(boxes) > 0 else []
     conf = boxes.conf.cpu().numpy().tolist() if len(boxes) > 0 else []
 
+    # Lưu ảnh upload có badge confidence mơ hồ để train lại
+    hard_example_sampler.consider("upload", img_np, {
+        "boxes_xyxy": detections,
+        "classes": classes,
+        "confidence": conf
+    }, rgb=True)
+
     return buf.getvalue(), {
         "boxes_xyxy": detections,
         "classes": classes,
@@ -307,7 +435,7 @@ def detect_badge_by_image(image_bytes: bytes):
     }
 
 # Combined Detection Function: Detect both humans and badges in an image
-def detect_combined_by_image(image_bytes: bytes):
+def detect_combined_by_image(image_bytes: bytes, qos="interactive", deadline=None):
     """
     Detect both humans and badges in an uploaded image
     Returns annotated image with green boxes for humans, blue boxes for badges
@@ -315,11 +443,12 @@ def detect_combined_by_image(image_bytes: bytes):
     img = check_image_bytes(image_bytes)
     img_np = np.array(img)  # RGB format from PIL
 
-    # Detect humans (class 0 = person) - YOLO works with RGB
-    human_results = model(img_np, classes=[0])
-    
-    # Detect badges - YOLO works with RGB
-    badge_results = badge_model(img_np)
+    with scheduler.slot(qos, deadline):
+        # Detect humans (class 0 = person) - YOLO works with RGB
+        human_results = model(img_np, classes=[0])
+        
+        # Detect badges - YOLO works with RGB
+        badge_results = badge_model(img_np)
 
     # Convert to BGR for OpenCV drawing
     img_bgr = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
@@ -372,172 +501,185 @@ def detect_combined_by_image(image_bytes: bytes):
     }
 
 # Function 05: Detect Badge From Real-time Camera
-def detect_badge_from_camera(camera_source=0, confidence_threshold=0.5):
-    """
-    Detect badges from real-time camera stream using CameraManager
-    """
-    stream_id = camera_manager.start_stream(camera_source)
-    
+def _badge_loop(channel, camera_source, confidence_threshold, qos):
+    """Detection loop: badge model trên frame mới nhất của camera, publish vào channel"""
+    reader = camera_manager.acquire(camera_source)
     try:
-        while True:
-            frame = camera_manager.get_frame(stream_id)
-            
-            if frame is None:
-                if stream_id != camera_manager.active_stream_id:
-                    print("Stream preempted by new request")
-                    break
-                print("Cannot read frame from camera")
-                break
-            
-            # Chạy badge detection với confidence threshold
-            results = badge_model(frame, conf=confidence_threshold)
-            
-            annotated_frame = results[0].plot()
-            
-            ret, buffer = cv2.imencode('.jpg', annotated_frame)
-            if not ret:
+        for seq, frame, captured_at in _live_frames(channel, reader):
+            # Chạy badge detection (confidence hạ xuống cho sampler nếu cần)
+            try:
+                with scheduler.slot(qos):
+                    results = badge_model(frame, conf=_badge_stream_conf(confidence_threshold))
+            except DeadlineExceeded:
                 continue
-                
-            frame_bytes = buffer.tobytes()
             
-            # Lấy detection data
-            boxes = results[0].boxes
-            detections = {
-                "boxes_xyxy": boxes.xyxy.cpu().numpy().tolist() if len(boxes) > 0 else [],
-                "classes": boxes.cls.cpu().numpy().tolist() if len(boxes) > 0 else [],
-                "confidence": boxes.conf.cpu().numpy().tolist() if len(boxes) > 0 else [],
-                "count": len(boxes)
-            }
+            # Sampler xem mọi badge từ SAMPLER_CONF_LOW, phần còn lại chỉ thấy badge >= threshold
+            hard_example_sampler.consider(camera_source, frame, boxes_to_detections(results[0].boxes))
+            result = _above(results[0], confidence_threshold)
             
-            yield frame_bytes, detections
+            # Lấy detection data
+            detections = boxes_to_detections(result.boxes)
             
+            event_store.record(camera_source, "badge", detections)
+            snapshot_cache.put(camera_source, "badge", result, detections, confidence_threshold)
+            channel.publish({
+                "seq": seq,
+                "timestamp": captured_at,
+                "detections": detections,
+                "frame": result.plot() if channel.wants_frames else None
+            })
     finally:
-        camera_manager.stop_stream(stream_id)
+        camera_manager.release(reader)
+
+def detect_badge_from_camera(camera_source=0, confidence_threshold=0.5, frames=True, max_fps=None, qos="live",
+                             share=False):
+    """
+    Subscribe vào badge detection loop của camera (chạy loop nếu chưa có)
+
+    Tham số và giá trị trả về giống detect_human_from_camera.
+    """
+    return _subscribe("badge", _badge_loop, camera_source, confidence_threshold, frames, max_fps, qos, share)
 
 # Function 06: Detect Badge From Camera (Single Frame)
-def detect_badge_from_camera_single_frame(camera_source=0, confidence_threshold=0.5):
+def detect_badge_from_camera_single_frame(camera_source=0, confidence_threshold=0.5, qos="interactive", deadline=None,
+                                          snapshot=None):
     """
     Capture single frame from camera and detect badges using CameraManager
+
+    Giống detect_human_from_camera_single_frame: capture warm + kết quả cache của live stream.
     """
-    stream_id = camera_manager.start_stream(camera_source)
+    if snapshot is None:
+        cached = cached_snapshot(camera_source, "badge", confidence_threshold)
+        if cached is not None:
+            return cached
+        snapshot = camera_manager.snapshot(camera_source)
+    frame, captured_at = snapshot
     
-    try:
-        frame = None
-        for _ in range(5):
-            frame = camera_manager.get_frame(stream_id)
-            if frame is not None:
-                break
-            time.sleep(0.1)
-            
-        if frame is None:
-            raise ValueError("Cannot read frame from camera")
-        
-        # Chạy badge detection với confidence threshold
+    # Chạy badge detection với confidence threshold
+    with scheduler.slot(qos, deadline):
         results = badge_model(frame, conf=confidence_threshold)
-        
-        annotated_frame = results[0].plot()
-        
-        ret, buffer = cv2.imencode('.jpg', annotated_frame)
-        if not ret:
-            raise ValueError("Cannot encode frame to JPEG")
-        
-        frame_bytes = buffer.tobytes()
-        
-        # Lấy detection data
-        boxes = results[0].boxes
-        detections = {
-            "boxes_xyxy": boxes.xyxy.cpu().numpy().tolist() if len(boxes) > 0 else [],
-            "classes": boxes.cls.cpu().numpy().tolist() if len(boxes) > 0 else [],
-            "confidence": boxes.conf.cpu().numpy().tolist() if len(boxes) > 0 else [],
-            "count": len(boxes)
-        }
-        
-        return frame_bytes, detections
-        
-    finally:
-        camera_manager.stop_stream(stream_id)
+    
+    # Lấy detection data
+    detections = boxes_to_detections(results[0].boxes)
+    
+    event_store.record(camera_source, "badge", detections)
+    snapshot_cache.put(camera_source, "badge", results[0], detections, confidence_threshold)
+    
+    age_ms = round((time.time() - captured_at) * 1000, 1)
+    return encode_snapshot(results[0]), detections, {"cached": False, "age_ms": age_ms}
 
 # ============================================================
 # COMBINED DETECTION FUNCTION
 # ============================================================
 
 # Function 07: Detect Both Human and Badge From Camera (Combined)
-def detect_combined_from_camera(camera_source=0, confidence_threshold=0.5):
-    """
-    Run both human and badge detection on same camera stream using CameraManager
-    """
-    stream_id = camera_manager.start_stream(camera_source)
+def _draw_combined(frame, human_boxes, badge_boxes):
+    """Vẽ box người (GREEN) và badge (BLUE) lên bản copy của frame"""
+    # Start with original frame
+    annotated = frame.copy()
+
+    # Draw human boxes (GREEN)
+    for box in human_boxes:
+        x1, y1, x2, y2 = map(int, box.xyxy[0].cpu().numpy())
+        conf = float(box.conf[0].cpu().numpy())
+
+        # Green rectangle for humans
+        cv2.rectangle(annotated, (x1, y1), (x2, y2), (0, 255, 0), 2)
+
+        # Label with confidence
+        label = f'Person {conf:.2f}'
+        cv2.putText(annotated, label, (x1, y1 - 10),
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+
+    # Draw badge boxes (BLUE)
+    for box in badge_boxes:
+        x1, y1, x2, y2 = map(int, box.xyxy[0].cpu().numpy())
+        conf = float(box.conf[0].cpu().numpy())
+
+        # Blue rectangle for badges
+        cv2.rectangle(annotated, (x1, y1), (x2, y2), (255, 0, 0), 2)
+
+        # Label with confidence
+        label = f'Badge {conf:.2f}'
+        cv2.putText(annotated, label, (x1, y1 - 10),
+                   cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
+    return annotated
+
+def _combined_loop(channel, camera_source, confidence_threshold, qos):
+    """Detection loop: human + badge model trên cùng frame, publish vào channel"""
+    reader = camera_manager.acquire(camera_source)
+    # Ring buffer clip bằng chứng lấy frame gốc ngay trên capture thread (mọi frame,
+    # lấy mẫu theo RECORDER_FPS), không phụ thuộc tốc độ của loop hay viewer
+    def record(frame, captured_at):
+        clip_recorder.add_frame(camera_source, frame, captured_at)
+    reader.add_tap(record)
     
     try:
-        while True:
-            frame = camera_manager.get_frame(stream_id)
-            
-            if frame is None:
-                if stream_id != camera_manager.active_stream_id:
-                    print("Stream preempted by new request")
-                    break
-                print("Cannot read frame from camera")
-                break
-            
+        for seq, frame, captured_at in _live_frames(channel, reader):
             # Run both models on same frame
-            human_results = model(frame, conf=confidence_threshold, classes=[0])
-            badge_results = badge_model(frame, conf=confidence_threshold)
-            
-            # Start with original frame
-            annotated = frame.copy()
+            try:
+                with scheduler.slot(qos):
+                    human_results = model(frame, conf=confidence_threshold, classes=[0])
+                    badge_results = badge_model(frame, conf=_badge_stream_conf(confidence_threshold))
+            except DeadlineExceeded:
+                continue
             
-            # Draw human boxes (GREEN)
+            # Badge dưới threshold (từ SAMPLER_CONF_LOW) chỉ dành cho sampler
+            all_badge_boxes = badge_results[0].boxes
+            badge_result = _above(badge_results[0], confidence_threshold)
             human_boxes = human_results[0].boxes
-            for box in human_boxes:
-                x1, y1, x2, y2 = map(int, box.xyxy[0].cpu().numpy())
-                conf = float(box.conf[0].cpu().numpy())
-                
-                # Green rectangle for humans
-                cv2.rectangle(annotated, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                
-                # Label with confidence
-                label = f'Person {conf:.2f}'
-                cv2.putText(annotated, label, (x1, y1 - 10),
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
-            
-            # Draw badge boxes (BLUE)
-            badge_boxes = badge_results[0].boxes
-            for box in badge_boxes:
-                x1, y1, x2, y2 = map(int, box.xyxy[0].cpu().numpy())
-                conf = float(box.conf[0].cpu().numpy())
-                
-                # Blue rectangle for badges
-                cv2.rectangle(annotated, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                
-                # Label with confidence
-                label = f'Badge {conf:.2f}'
-                cv2.putText(annotated, label, (x1, y1 - 10),
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
-            
-            # Convert to JPEG
-            ret, buffer = cv2.imencode('.jpg', annotated)
-            if not ret:
-                continue
-                
-            frame_bytes = buffer.tobytes()
+            badge_boxes = badge_result.boxes
+            annotated = _draw_combined(frame, human_boxes, badge_boxes) if channel.wants_frames else None
             
             # Combine detection data
             detections = {
                 "humans": {
                     "count": len(human_boxes),
                     "boxes": human_boxes.xyxy.cpu().numpy().tolist() if len(human_boxes) > 0 else [],
+                    "classes": human_boxes.cls.cpu().numpy().tolist() if len(human_boxes) > 0 else [],
                     "confidence": human_boxes.conf.cpu().numpy().tolist() if len(human_boxes) > 0 else []
                 },
                 "badges": {
                     "count": len(badge_boxes),
                     "boxes": badge_boxes.xyxy.cpu().numpy().tolist() if len(badge_boxes) > 0 else [],
+                    "classes": badge_boxes.cls.cpu().numpy().tolist() if len(badge_boxes) > 0 else [],
                     "confidence": badge_boxes.conf.cpu().numpy().tolist() if len(badge_boxes) > 0 else []
                 },
                 "total_count": len(human_boxes) + len(badge_boxes)
             }
             
-            yield frame_bytes, detections
+            event_store.record(camera_source, "combined", detections)
+            hard_example_sampler.consider(camera_source, frame, dict(detections, badges={
+                "count": len(all_badge_boxes),
+                "boxes": all_badge_boxes.xyxy.cpu().numpy().tolist() if len(all_badge_boxes) > 0 else [],
+                "classes": all_badge_boxes.cls.cpu().numpy().tolist() if len(all_badge_boxes) > 0 else [],
+                "confidence": all_badge_boxes.conf.cpu().numpy().tolist() if len(all_badge_boxes) > 0 else []
+            }))
+            
+            # Snapshot của cùng camera dùng lại kết quả của từng model
+            snapshot_cache.put(camera_source, "human", human_results[0], boxes_to_detections(human_boxes), confidence_threshold)
+            snapshot_cache.put(camera_source, "badge", badge_result, boxes_to_detections(badge_boxes), confidence_threshold)
+            
+            # Có người nhưng thiếu badge -> lưu clip + keyframe
+            if len(human_boxes) > len(badge_boxes):
+                clip_recorder.trigger(camera_source, annotated if annotated is not None else frame, detections)
             
+            channel.publish({
+                "seq": seq,
+                "timestamp": captured_at,
+                "detections": detections,
+                "frame": annotated
+            })
     finally:
-        camera_manager.stop_stream(stream_id)
+        reader.remove_tap(record)
+        clip_recorder.flush(camera_source)
+        camera_manager.release(reader)
 
+def detect_combined_from_camera(camera_source=0, confidence_threshold=0.5, frames=True, max_fps=None, qos="live",
+                                share=False):
+    """
+    Subscribe vào combined (human + badge) detection loop của camera (chạy loop nếu chưa có)
+
+    Tham số và giá trị trả về giống detect_human_from_camera.
+    """
+    return _subscribe("combined", _combined_loop, camera_source, confidence_threshold, frames, max_fps, qos, share)
@@ -0,0 +1,202 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+
+# ============================================================
+# ACTIVE LEARNING: HARD-EXAMPLE SAMPLER
+# ============================================================
+# Lưu lại các frame "khó" từ traffic thật để gán nhãn và train lại badge model:
+# - badge có confidence nằm trong khoảng mơ hồ (mặc định 0.3 - 0.6)
+# - có người nhưng số badge ít hơn số người
+# Các frame gần giống nhau bị loại bằng perceptual hash (dHash 64 bit),
+# số frame được lưu bị giới hạn theo thời gian, và việc ghi file chạy ở thread nền.
+#
+# Dataset layout (dùng với badge_detection/make_labels.py):
+#   <dir>/images/<id>.jpg
+#   <dir>/meta/<id>.json
+#
+# Cấu hình qua biến môi trường:
+# - SAMPLER_ENABLED        (1/0, mặc định 1)
+# - SAMPLER_DIR            (mặc định <core>/data/hard_examples)
+# - SAMPLER_CONF_LOW       (mặc định 0.3; detection loop của live stream chạy badge model ở
+#                           min(SAMPLER_CONF_LOW, threshold) rồi lọc lại theo threshold,
+#                           nên sampler thấy cả badge dưới threshold của stream)
+# - SAMPLER_CONF_HIGH      (mặc định 0.6)
+# - SAMPLER_MIN_INTERVAL   (giây giữa 2 lần lưu của một source, mặc định 2)
+# - SAMPLER_MAX_PER_HOUR   (mặc định 200)
+# - SAMPLER_HASH_DISTANCE  (Hamming distance tối thiểu so với frame đã lưu, mặc định 6)
+
+DEFAULT_SAMPLE_DIR = os.path.join(os.path.dirname(__file__), "..", "data", "hard_examples")
+HASH_HISTORY = 512
+
+def dhash(frame, rgb=False):
+    """Perceptual hash 64 bit (difference hash) của frame"""
+    small = cv2.resize(frame, (9, 8), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+def _parse_detections(detections):
+    """
+    Trả về (human_count, badge_boxes, badge_confidence, badge_classes)
+    từ detections dict dạng badge (boxes_xyxy) hoặc combined (humans/badges).
+    """
+    if "badges" in detections or "humans" in detections:
+        badges = detections.get("badges", {})
+        boxes = badges.get("boxes", [])
+        return (detections.get("humans", {}).get("count", 0), boxes,
+                badges.get("confidence", []), badges.get("classes", [0] * len(boxes)))
+    return (None, detections.get("boxes_xyxy", []),
+            detections.get("confidence", []), detections.get("classes", []))
+
+class HardExampleSampler:
+    """
+    Chọn và lưu frame khó. `consider()` chạy trong vòng lặp inference:
+    chỉ so sánh vài số float cho phần lớn frame, hash + copy chỉ khi frame thỏa điều kiện.
+    """
+
+    def __init__(self, sample_dir=DEFAULT_SAMPLE_DIR, conf_low=0.3, conf_high=0.6,
+                 min_interval=2.0, max_per_hour=200, hash_distance=6, enabled=True):
+        self.sample_dir = os.path.abspath(sample_dir)
+        self.conf_low = conf_low
+        self.conf_high = conf_high
+        self.min_interval = min_interval
+        self.max_per_hour = max_per_hour
+        self.hash_distance = hash_distance
+        self.enabled = enabled
+
+        self._hashes = collections.deque(maxlen=HASH_HISTORY)
+        self._last_saved = {}
+        self._saved_times = collections.deque()
+        self._queue = queue.Queue(maxsize=32)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.saved = 0
+        self.duplicates = 0
+        self.dropped = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            sample_dir=os.getenv("SAMPLER_DIR", DEFAULT_SAMPLE_DIR),
+            conf_low=float(os.getenv("SAMPLER_CONF_LOW", "0.3")),
+            conf_high=float(os.getenv("SAMPLER_CONF_HIGH", "0.6")),
+            min_interval=float(os.getenv("SAMPLER_MIN_INTERVAL", "2")),
+            max_per_hour=int(os.getenv("SAMPLER_MAX_PER_HOUR", "200")),
+            hash_distance=int(os.getenv("SAMPLER_HASH_DISTANCE", "6")),
+            enabled=os.getenv("SAMPLER_ENABLED", "1") != "0"
+        )
+
+    def _reason(self, human_count, badge_boxes, badge_conf):
+        if any(self.conf_low <= c <= self.conf_high for c in badge_conf):
+            return "uncertain_badge"
+        if human_count is not None and human_count > len(badge_boxes):
+            return "person_without_badge"
+        return None
+
+    def consider(self, source, frame, detections, rgb=False):
+        """
+        Kiểm tra frame và đưa vào hàng đợi ghi nếu là hard example.
+        Trả về reason nếu frame được chọn, ngược lại None.
+        """
+        if not self.enabled or frame.ndim != 3 or frame.shape[2] != 3:
+            return None
+
+        human_count, badge_boxes, badge_conf, badge_classes = _parse_detections(detections)
+        reason = self._reason(human_count, badge_boxes, badge_conf)
+        if reason is None:
+            return None
+
+        now = time.time()
+        key = str(source)
+        # Được gọi đồng thời từ stream generator và upload handler (threadpool):
+        # kiểm tra + ghi nhận lịch sử phải nằm trong cùng một lock
+        with self._lock:
+            if now - self._last_saved.get(key, 0.0) < self.min_interval:
+                return None
+            while self._saved_times and now - self._saved_times[0] > 3600:
+                self._saved_times.popleft()
+            if len(self._saved_times) >= self.max_per_hour:
+                return None
+
+            frame_hash = dhash(frame, rgb)
+            if any((frame_hash ^ h).bit_count() < self.hash_distance for h in self._hashes):
+                self.duplicates += 1
+                return None
+
+            self._hashes.append(frame_hash)
+            self._last_saved[key] = now
+            self._saved_times.append(now)
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait({
+                "source": key,
+                "timestamp": now,
+                "reason": reason,
+                "hash": f"{frame_hash:016x}",
+                "frame": frame.copy(),
+                "rgb": rgb,
+                "height": int(frame.shape[0]),
+                "width": int(frame.shape[1]),
+                "human_count": human_count,
+                "badges": [
+                    {"box": list(box), "confidence": float(conf), "class": int(cls)}
+                    for box, conf, cls in zip(badge_boxes, badge_conf, badge_classes)
+                ]
+            })
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return None
+        return reason
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer_loop, name="hard-example-writer", daemon=True)
+                self._thread.start()
+
+    def _writer_loop(self):
+        images_dir = os.path.join(self.sample_dir, "images")
+        meta_dir = os.path.join(self.sample_dir, "meta")
+        os.makedirs(images_dir, exist_ok=True)
+        os.makedirs(meta_dir, exist_ok=True)
+
+        while True:
+            sample = self._queue.get()
+            try:
+                frame = sample.pop("frame")
+                if sample.pop("rgb"):
+                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                sample_id = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(sample['timestamp']))}_{sample['hash']}"
+                cv2.imwrite(os.path.join(images_dir, sample_id + ".jpg"), frame)
+                with open(os.path.join(meta_dir, sample_id + ".json"), "w") as f:
+                    json.dump(sample, f)
+                self.saved += 1
+            except Exception as e:
+                print(f"Hard example write error: {e}")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "sample_dir": self.sample_dir,
+            "saved": self.saved,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "last_hour": len(self._saved_times)
+        }
+
+# Global hard-example sampler
+hard_example_sampler = HardExampleSampler.from_env()
@@ -1,4 +1,5 @@
-from fastapi import FastAPI, File, UploadFile, Query
+from fastapi import FastAPI, File, UploadFile, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from api.functions import (
@@ -9,9 +10,21 @@ from api.functions import (
     detect_badge_from_camera,
     detect_badge_from_camera_single_frame,
     detect_combined_from_camera,
-    detect_combined_by_image
+    detect_combined_by_image,
+    cached_snapshot
 )
+from api.events import detection_events, shared_detections, EVENT_FORMATS, EVENT_MODES
+from api.streaming import AdaptiveStream, ClosingStreamingResponse, mjpeg_frames
+from api.event_store import event_store
+from api.recorder import clip_recorder
+from api.hard_examples import hard_example_sampler
+from api.models import models_info
+from api.snapshots import snapshot_cache
+from api.scheduler import scheduler, rate_limiter, lower_priority, QosError, InvalidQosHeader, QOS_CLASSES
+from typing import Optional
+import time
 import base64
+import math
 import os
 
 # Khởi tạo FastAPI với metadata
@@ -24,13 +37,76 @@ app = FastAPI(
 )
 
 # Import camera manager
-from api.functions import camera_manager
+from api.functions import camera_manager, badge_model_manifest, model, badge_model
 
 @app.on_event("shutdown")
 def shutdown_event():
     """Release camera on shutdown"""
     print("Shutting down... Releasing camera resources")
     camera_manager.force_release()
+    event_store.close()
+
+# ============================================================
+# QOS: PRIORITY CLASS + RATE LIMIT CHO MỖI REQUEST
+# ============================================================
+
+def _admit(request: Request, default="interactive"):
+    """
+    Rate limit theo API key (X-API-Key, không có thì theo IP client) và chọn
+    priority class cho request:
+    - X-Priority chỉ được hạ độ ưu tiên so với mặc định của endpoint
+    - QOS_API_KEYS giới hạn class cao nhất của từng key
+    - X-Deadline-Ms chỉ được rút ngắn deadline mặc định của class
+
+    Returns: (qos, deadline)
+    """
+    api_key = request.headers.get("X-API-Key")
+    client = api_key or (request.client.host if request.client else "unknown")
+    rate_limiter.check(client)
+
+    requested = request.headers.get("X-Priority")
+    if requested is not None and requested not in QOS_CLASSES:
+        raise InvalidQosHeader(f"Invalid priority class: {requested}")
+    qos = lower_priority(default, requested, rate_limiter.key_classes.get(api_key))
+
+    deadline = None
+    deadline_ms = request.headers.get("X-Deadline-Ms")
+    if deadline_ms:
+        try:
+            value = float(deadline_ms)
+        except ValueError:
+            raise InvalidQosHeader(f"Invalid X-Deadline-Ms: {deadline_ms}")
+        if not math.isfinite(value) or value <= 0:
+            raise InvalidQosHeader(f"Invalid X-Deadline-Ms: {deadline_ms}")
+        deadline = scheduler.deadline_for(qos, min(value, scheduler.deadlines[qos] * 1000))
+    return qos, deadline
+
+def qos_error_response(e: QosError):
+    """400 (header sai) / 429 (rate limit) / 503 (quá deadline, kèm Retry-After)"""
+    headers = None
+    if e.status_code != 400:
+        headers = {"Retry-After": str(max(1, round(e.retry_after)))}
+    return JSONResponse(
+        status_code=e.status_code,
+        content={"success": False, "error": str(e)},
+        headers=headers
+    )
+
+async def _run_snapshot(detect_fn, kind, source, confidence, qos, deadline):
+    """
+    Snapshot: dùng kết quả live stream nếu còn mới; nếu không thì đọc frame, chờ slot
+    inference trên event loop (không giữ thread của threadpool) rồi mới chạy model
+    """
+    snapshot = await run_in_threadpool(cached_snapshot, source, kind, confidence)
+    if snapshot is not None:
+        return snapshot
+    frame = await run_in_threadpool(camera_manager.snapshot, source)
+    async with scheduler.async_slot(qos, deadline):
+        return await run_in_threadpool(detect_fn, source, confidence, None, snapshot=frame)
+
+@app.exception_handler(QosError)
+async def qos_exception_handler(request: Request, e: QosError):
+    return qos_error_response(e)
 
 # UI is now served by Nginx, so we don't need to mount static files here
 # Mount UI directory
@@ -65,21 +141,32 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "service": "ai-processing"}
 
+@app.get("/models")
+async def models_endpoint():
+    """Thông tin backend, model đã load, runtime profile và manifest của badge model"""
+    info = models_info([model, badge_model])
+    info["badge_model"] = badge_model_manifest
+    return info
+
 @app.post("/detect_human_by_image")
-async def detect_human_by_image_api(file: UploadFile = File(...)):
+async def detect_human_by_image_api(request: Request, file: UploadFile = File(...)):
     """
     Detect người trong ảnh
     
     - **file**: File ảnh upload (JPEG, PNG, etc.)
+    - Header **X-Priority**: `interactive` (mặc định) hoặc `bulk`
     
     Returns:
     - **annotated_image**: Ảnh đã được vẽ bounding boxes (base64 encoded)
     - **detections**: Danh sách các detection với boxes, classes, confidence
     """
     try:
+        qos, deadline = _admit(request)
         image_bytes = await file.read()
         
-        annotated_bytes, result_json = detect_human_by_image(image_bytes)
+        # Chờ slot trên event loop: bulk đang xếp hàng không giữ thread của threadpool
+        async with scheduler.async_slot(qos, deadline):
+            annotated_bytes, result_json = await run_in_threadpool(detect_human_by_image, image_bytes, None)
         
         # Encode annotated image to base64 để trả về JSON
         annotated_base64 = base64.b64encode(annotated_bytes).decode('utf-8')
@@ -90,6 +177,8 @@ async def detect_human_by_image_api(file: UploadFile = File(...)):
             "detections": result_json,
             "total_detections": len(result_json.get("boxes_xyxy", []))
         }
+    except QosError as e:
+        return qos_error_response(e)
     except ValueError as e:
         return JSONResponse(
             status_code=400,
@@ -103,14 +192,21 @@ async def detect_human_by_image_api(file: UploadFile = File(...)):
 
 @app.get("/camera/stream")
 async def camera_stream(
+    request: Request,
     source: int = Query(0, description="Camera source (0 for default webcam)"),
-    confidence: float = Query(0.5, ge=0.0, le=1.0, description="Confidence threshold")
+    confidence: float = Query(0.5, ge=0.0, le=1.0, description="Confidence threshold"),
+    quality: int = Query(95, ge=10, le=100, description="JPEG quality tối đa"),
+    max_width: Optional[int] = Query(None, ge=32, description="Chiều rộng tối đa của frame"),
+    max_fps: float = Query(30.0, gt=0.0, le=120.0, description="FPS tối đa"),
+    adaptive: bool = Query(True, description="Tự động giảm quality/resolution/FPS khi client chậm")
 ):
     """
     Stream real-time camera với human detection
     
     - **source**: Camera source (0 = webcam mặc định)
     - **confidence**: Ngưỡng confidence (0.0 - 1.0)
+    - **quality**, **max_width**, **max_fps**: Giới hạn cho viewer này
+    - **adaptive**: Điều chỉnh theo tốc độ mạng của viewer
     
     Returns: MJPEG video stream
     
@@ -119,37 +215,56 @@ async def camera_stream(
     <img src="http://localhost:6033/camera/stream?source=0&confidence=0.5" />
     ```
     """
+    qos, _ = _admit(request, "live")
+    viewer = AdaptiveStream(quality, max_width, max_fps, adaptive)
+
     def generate_frames():
         try:
-            for frame_bytes, detections in detect_human_from_camera(source, confidence):
-                # Tạo multipart response cho MJPEG stream
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            # Tạo multipart response cho MJPEG stream
+            yield from mjpeg_frames(detect_human_from_camera(source, confidence, max_fps=viewer.fps, qos=qos), viewer)
         except Exception as e:
             print(f"Error in camera stream: {e}")
+        finally:
+            print(f"Camera stream closed: {viewer.stats()}")
     
-    return StreamingResponse(
+    return ClosingStreamingResponse(
         generate_frames(),
         media_type="multipart/x-mixed-replace; boundary=frame"
     )
 
+@app.get("/camera/health")
+async def camera_health():
+    """
+    Sức khỏe các camera source: state (connected / stalled / reconnecting / error / closed),
+    fps, tuổi của frame gần nhất, số lần đọc lỗi, reconnect và stall.
+    unused_s = số giây từ lần cuối stream / snapshot lấy frame (capture được đóng sau CAMERA_IDLE_TIMEOUT)
+    """
+    return {"sources": camera_manager.health_report(), "snapshot_cache": snapshot_cache.stats()}
+
 @app.get("/camera/snapshot")
 async def camera_snapshot(
+    request: Request,
     source: int = Query(0, description="Camera source (0 for default webcam)"),
     confidence: float = Query(0.5, ge=0.0, le=1.0, description="Confidence threshold")
 ):
     """
     Capture một frame từ camera và detect người
     
+    Frame lấy từ capture đang mở (live stream không bị ngắt); kết quả detect
+    của live stream được dùng lại nếu đủ mới.
+    
     - **source**: Camera source (0 = webcam mặc định)
     - **confidence**: Ngưỡng confidence (0.0 - 1.0)
     
     Returns:
     - **annotated_image**: Ảnh đã được vẽ bounding boxes (base64 encoded)
     - **detections**: Danh sách các detection với boxes, classes, confidence, count
+    - **cached**: True nếu dùng lại kết quả của live stream
+    - **age_ms**: Tuổi của frame / kết quả
     """
     try:
-        frame_bytes, detections = detect_human_from_camera_single_frame(source, confidence)
+        qos, deadline = _admit(request)
+        frame_bytes, detections, snapshot_info = await _run_snapshot(detect_human_from_camera_single_frame, "human", source, confidence, qos, deadline)
         
         # Encode to base64
         frame_base64 = base64.b64encode(frame_bytes).decode('utf-8')
@@ -158,8 +273,12 @@ async def camera_snapshot(
             "success": True,
             "annotated_image": frame_base64,
             "detections": detections,
-            "total_detections": detections.get("count", 0)
+            "total_detections": detections.get("count", 0),
+            "cached": snapshot_info["cached"],
+            "age_ms": snapshot_info["age_ms"]
         }
+    except QosError as e:
+        return qos_error_response(e)
     except ValueError as e:
         return JSONResponse(
             status_code=400,
@@ -176,11 +295,14 @@ async def camera_snapshot(
 # ============================================================
 
 @app.post("/detect_badge_by_image")
-async def detect_badge_by_image_api(file: UploadFile = File(...)):
-    """Detect badges in uploaded image"""
+async def detect_badge_by_image_api(request: Request, file: UploadFile = File(...)):
+    """Detect badges in uploaded image (header X-Priority: interactive | bulk)"""
     try:
+        qos, deadline = _admit(request)
         image_bytes = await file.read()
-        annotated_bytes, result_json = detect_badge_by_image(image_bytes)
+        # Chờ slot trên event loop: bulk đang xếp hàng không giữ thread của threadpool
+        async with scheduler.async_slot(qos, deadline):
+            annotated_bytes, result_json = await run_in_threadpool(detect_badge_by_image, image_bytes, None)
         annotated_base64 = base64.b64encode(annotated_bytes).decode('utf-8')
         
         return {
@@ -189,37 +311,55 @@ async def detect_badge_by_image_api(file: UploadFile = File(...)):
             "detections": result_json,
             "total_detections": len(result_json.get("boxes_xyxy", []))
         }
+    except QosError as e:
+        return qos_error_response(e)
     except ValueError as e:
         return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
     except Exception as e:
         return JSONResponse(status_code=500, content={"success": False, "error": str(e)})
 
 @app.get("/badge/stream")
-async def badge_stream(source: int = Query(0), confidence: float = Query(0.5)):
-    """Stream real-time badge detection from camera"""
+async def badge_stream(
+    request: Request,
+    source: int = Query(0),
+    confidence: float = Query(0.5),
+    quality: int = Query(95, ge=10, le=100),
+    max_width: Optional[int] = Query(None, ge=32),
+    max_fps: float = Query(30.0, gt=0.0, le=120.0),
+    adaptive: bool = Query(True)
+):
+    """Stream real-time badge detection from camera (adaptive quality/resolution/FPS per viewer)"""
+    qos, _ = _admit(request, "live")
+    viewer = AdaptiveStream(quality, max_width, max_fps, adaptive)
+
     def generate_frames():
         try:
-            for frame_bytes, detections in detect_badge_from_camera(source, confidence):
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            yield from mjpeg_frames(detect_badge_from_camera(source, confidence, max_fps=viewer.fps, qos=qos), viewer)
         except Exception as e:
             print(f"Error in badge stream: {e}")
+        finally:
+            print(f"Badge stream closed: {viewer.stats()}")
     
-    return StreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+    return ClosingStreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
 
 @app.get("/badge/snapshot")
-async def badge_snapshot(source: int = Query(0), confidence: float = Query(0.5)):
+async def badge_snapshot(request: Request, source: int = Query(0), confidence: float = Query(0.5)):
     """Capture single frame and detect badges"""
     try:
-        frame_bytes, detections = detect_badge_from_camera_single_frame(source, confidence)
+        qos, deadline = _admit(request)
+        frame_bytes, detections, snapshot_info = await _run_snapshot(detect_badge_from_camera_single_frame, "badge", source, confidence, qos, deadline)
         frame_base64 = base64.b64encode(frame_bytes).decode('utf-8')
         
         return {
             "success": True,
             "annotated_image": frame_base64,
             "detections": detections,
-            "total_detections": detections.get("count", 0)
+            "total_detections": detections.get("count", 0),
+            "cached": snapshot_info["cached"],
+            "age_ms": snapshot_info["age_ms"]
         }
+    except QosError as e:
+        return qos_error_response(e)
     except ValueError as e:
         return JSONResponse(status_code=400, content={"success": False, "error": str(e)})
     except Exception as e:
@@ -230,11 +370,12 @@ async def badge_snapshot(source: int = Query(0), confidence: float = Query(0.5))
 # ============================================================
 
 @app.post("/detect_combined_by_image")
-async def detect_combined_by_image_api(file: UploadFile = File(...)):
+async def detect_combined_by_image_api(request: Request, file: UploadFile = File(...)):
     """
     Detect both humans and badges in an image
     
     - **file**: File ảnh upload (JPEG, PNG, etc.)
+    - Header **X-Priority**: `interactive` (mặc định) hoặc `bulk`
     
     Returns:
     - **annotated_image**: Ảnh với green boxes (humans) và blue boxes (badges)
@@ -242,9 +383,12 @@ async def detect_combined_by_image_api(file: UploadFile = File(...)):
     - **badge_count**: Số badge phát hiện
     """
     try:
+        qos, deadline = _admit(request)
         image_bytes = await file.read()
         
-        annotated_bytes, result_json = detect_combined_by_image(image_bytes)
+        # Chờ slot trên event loop: bulk đang xếp hàng không giữ thread của threadpool
+        async with scheduler.async_slot(qos, deadline):
+            annotated_bytes, result_json = await run_in_threadpool(detect_combined_by_image, image_bytes, None)
         
         # Encode annotated image to base64
         annotated_base64 = base64.b64encode(annotated_bytes).decode('utf-8')
@@ -258,6 +402,8 @@ async def detect_combined_by_image_api(file: UploadFile = File(...)):
             "human_confidence": result_json.get("human_confidence", []),
             "badge_confidence": result_json.get("badge_confidence", [])
         }
+    except QosError as e:
+        return qos_error_response(e)
     except ValueError as e:
         return JSONResponse(
             status_code=400,
@@ -270,14 +416,176 @@ async def detect_combined_by_image_api(file: UploadFile = File(...)):
         )
 
 @app.get("/combined/stream")
-async def combined_stream(source: int = Query(0), confidence: float = Query(0.5)):
-    """Stream with both human and badge detection (green and blue boxes)"""
+async def combined_stream(
+    request: Request,
+    source: int = Query(0),
+    confidence: float = Query(0.5),
+    quality: int = Query(95, ge=10, le=100),
+    max_width: Optional[int] = Query(None, ge=32),
+    max_fps: float = Query(30.0, gt=0.0, le=120.0),
+    adaptive: bool = Query(True)
+):
+    """Stream with both human and badge detection (green and blue boxes) (adaptive quality/resolution/FPS per viewer)"""
+    qos, _ = _admit(request, "live")
+    viewer = AdaptiveStream(quality, max_width, max_fps, adaptive)
+
     def generate_frames():
         try:
-            for frame_bytes, detections in detect_combined_from_camera(source, confidence):
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            yield from mjpeg_frames(detect_combined_from_camera(source, confidence, max_fps=viewer.fps, qos=qos), viewer)
         except Exception as e:
             print(f"Error in combined stream: {e}")
+        finally:
+            print(f"Combined stream closed: {viewer.stats()}")
     
-    return StreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+    return ClosingStreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+
+
+# ============================================================
+# DETECTION EVENT STREAMS (METADATA ONLY, NO JPEG)
+# ============================================================
+
+EVENT_MEDIA_TYPES = {
+    "sse": "text/event-stream",
+    "ndjson": "application/x-ndjson"
+}
+
+def _event_stream_response(request, detect_fn, source, confidence, fmt, mode, tolerance, name):
+    """
+    Tạo StreamingResponse phát detection events.
+    Subscribe vào detection loop đang chạy của camera: cùng kind, hoặc combined loop
+    cho human / badge (ví dụ của MJPEG stream, confidence thấp hơn thì lọc lại).
+    Nếu chưa có thì chạy loop mới không vẽ box (frames=False)
+    """
+    if fmt not in EVENT_FORMATS:
+        return JSONResponse(status_code=400, content={"success": False, "error": f"Invalid format: {fmt}"})
+    if mode not in EVENT_MODES:
+        return JSONResponse(status_code=400, content={"success": False, "error": f"Invalid mode: {mode}"})
+    qos, _ = _admit(request, "live")
+
+    def generate_events():
+        try:
+            yield from detection_events(
+                shared_detections(detect_fn(source, confidence, frames=False, qos=qos, share=True)),
+                fmt=fmt, mode=mode, tolerance=tolerance
+            )
+        except Exception as e:
+            print(f"Error in {name} event stream: {e}")
+
+    return ClosingStreamingResponse(
+        generate_events(),
+        media_type=EVENT_MEDIA_TYPES[fmt],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/camera/events")
+async def camera_events(
+    request: Request,
+    source: int = Query(0, description="Camera source (0 for default webcam)"),
+    confidence: float = Query(0.5, ge=0.0, le=1.0, description="Confidence threshold"),
+    format: str = Query("sse", description="Event format: sse | ndjson"),
+    mode: str = Query("frame", description="frame = mỗi frame một event, change = chỉ khi detections thay đổi"),
+    tolerance: float = Query(10.0, ge=0.0, description="Ngưỡng dịch chuyển box (pixel) cho mode=change")
+):
+    """
+    Stream human detection metadata (không có ảnh)
+
+    Mỗi event gồm **seq** (số thứ tự frame của camera), **timestamp** (thời điểm capture)
+    và **detections**. Các client cùng camera nhận cùng seq cho cùng frame; seq bị nhảy
+    nghĩa là frame đó không được detect hoặc client đọc chậm nên bị bỏ.
+
+    Sử dụng trong JavaScript:
+    ```js
+    new EventSource("/camera/events?source=0&mode=change")
+    ```
+    """
+    return _event_stream_response(request, detect_human_from_camera, source, confidence, format, mode, tolerance, "camera")
+
+@app.get("/badge/events")
+async def badge_events(
+    request: Request,
+    source: int = Query(0),
+    confidence: float = Query(0.5, ge=0.0, le=1.0),
+    format: str = Query("sse"),
+    mode: str = Query("frame"),
+    tolerance: float = Query(10.0, ge=0.0)
+):
+    """Stream badge detection metadata (SSE hoặc NDJSON, không có ảnh)"""
+    return _event_stream_response(request, detect_badge_from_camera, source, confidence, format, mode, tolerance, "badge")
+
+@app.get("/combined/events")
+async def combined_events(
+    request: Request,
+    source: int = Query(0),
+    confidence: float = Query(0.5, ge=0.0, le=1.0),
+    format: str = Query("sse"),
+    mode: str = Query("frame"),
+    tolerance: float = Query(10.0, ge=0.0)
+):
+    """Stream human + badge detection metadata (SSE hoặc NDJSON, không có ảnh)"""
+    return _event_stream_response(request, detect_combined_from_camera, source, confidence, format, mode, tolerance, "combined")
+
+
+# ============================================================
+# DETECTION HISTORY (EVENT STORE) ENDPOINTS
+# ============================================================
+
+@app.get("/history/events")
+def history_events(
+    start: Optional[float] = Query(None, description="Unix timestamp bắt đầu (mặc định: 24h trước)"),
+    end: Optional[float] = Query(None, description="Unix timestamp kết thúc (mặc định: hiện tại)"),
+    camera: Optional[str] = Query(None, description="Camera source"),
+    kind: Optional[str] = Query(None, description="human | badge | combined"),
+    compliant: Optional[bool] = Query(None, description="Lọc theo trạng thái đeo badge (chỉ combined)"),
+    limit: int = Query(1000, ge=1, le=100000)
+):
+    """
+    Truy vấn detections đã lưu trong khoảng thời gian
+
+    Returns:
+    - **events**: Danh sách events (timestamp, camera, kind, counts, compliant, detections)
+    """
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - 86400
+    try:
+        events = event_store.query(start, end, camera=camera, kind=kind, compliant=compliant, limit=limit)
+        return {"success": True, "start": start, "end": end, "count": len(events), "events": events}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"success": False, "error": str(e)})
+
+@app.get("/history/hourly")
+def history_hourly(
+    start: Optional[float] = Query(None, description="Unix timestamp bắt đầu (mặc định: 24h trước)"),
+    end: Optional[float] = Query(None, description="Unix timestamp kết thúc (mặc định: hiện tại)"),
+    camera: Optional[str] = Query(None),
+    kind: Optional[str] = Query(None)
+):
+    """
+    Thống kê theo giờ: số events, tổng số người, badge và số lần vi phạm (người không đeo badge)
+    """
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - 86400
+    try:
+        hours = event_store.hourly(start, end, camera=camera, kind=kind)
+        return {"success": True, "start": start, "end": end, "hours": hours}
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"success": False, "error": str(e)})
+
+@app.get("/history/stats")
+async def history_stats():
+    """Trạng thái event store (queue, số event bị drop, cấu hình)"""
+    return event_store.stats()
+
+@app.get("/recorder/stats")
+async def recorder_stats():
+    """Trạng thái clip recorder (ring buffer mỗi camera, số clip đã ghi)"""
+    return clip_recorder.stats()
+
+@app.get("/sampler/stats")
+async def sampler_stats():
+    """Trạng thái hard-example sampler (số frame đã lưu, bị loại do trùng lặp)"""
+    return hard_example_sampler.stats()
+
+@app.get("/qos/stats")
+async def qos_stats():
+    """Trạng thái scheduler: slot đang chạy / đang chờ, số request bị drop và thời gian chờ theo priority class"""
+    return {"scheduler": scheduler.stats(), "rate_limit": rate_limiter.stats()}
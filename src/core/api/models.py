@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+
+# ============================================================
+# MODEL REGISTRY: BACKENDS + LAZY LOADING
+# ============================================================
+# Các import nặng (torch, ultralytics, onnxruntime) chỉ xảy ra khi model
+# đầu tiên của backend tương ứng được load. Với LAZY_MODELS=1, mỗi model chỉ
+# được load ở lần gọi đầu tiên: service chỉ dùng /detect_badge_by_image sẽ
+# không bao giờ load human model.
+#
+# Cấu hình qua biến môi trường:
+# - DETECTION_BACKEND  (yolo | onnx | stub, mặc định yolo)
+#     yolo: ultralytics + torch (đầy đủ, hỗ trợ GPU)
+#     onnx: onnxruntime, dùng <model>.onnx hoặc file onnx trong manifest (slim / edge)
+#     stub: model giả cho load test / CI
+# - LAZY_MODELS        (1/0, mặc định 0)
+# - MODEL_MMAP         (1/0, mặc định 0): torch.load(mmap=True) cho weights .pt
+
+DETECTION_BACKEND = os.getenv("DETECTION_BACKEND", "yolo")
+LAZY_MODELS = os.getenv("LAZY_MODELS", "0") == "1"
+MODEL_MMAP = os.getenv("MODEL_MMAP", "0") == "1"
+
+_device = None
+_runtime_profile = None
+_torch_lock = threading.Lock()
+
+def _patch_torch_load():
+    """
+    Monkey patch torch.load để tương thích với PyTorch 2.6
+    PHẢI PATCH TRƯỚC KHI IMPORT ULTRALYTICS
+    """
+    import torch
+
+    if getattr(torch.load, "_badge_patched", False):
+        return
+    _original_torch_load = torch.load
+
+    def _patched_torch_load(f, *args, **kwargs):
+        """Wrapper để set weights_only=False cho YOLO models"""
+        # Nếu không có weights_only trong kwargs, set mặc định là False
+        if 'weights_only' not in kwargs:
+            kwargs['weights_only'] = False
+        # Memory-map weights thay vì đọc toàn bộ file vào RAM
+        if MODEL_MMAP and isinstance(f, (str, os.PathLike)) and 'mmap' not in kwargs:
+            kwargs['mmap'] = True
+        return _original_torch_load(f, *args, **kwargs)
+
+    _patched_torch_load._badge_patched = True
+    torch.load = _patched_torch_load
+
+def get_device():
+    """Device cho inference ('cuda' chỉ khi backend yolo và có GPU)"""
+    global _device
+    if _device is None:
+        if DETECTION_BACKEND == "yolo":
+            import torch
+            _device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        else:
+            _device = 'cpu'
+        print(f"Using device: {_device}")
+    return _device
+
+def _onnx_path(weights_path, manifest):
+    """Ưu tiên file onnx trong manifest (train.py --publish), sau đó <weights>.onnx"""
+    exported = (manifest or {}).get("exports", {}).get("onnx")
+    if exported:
+        path = os.path.join(os.path.dirname(weights_path), exported)
+        if os.path.exists(path):
+            return path
+    return os.path.splitext(weights_path)[0] + ".onnx"
+
+def _load_yolo(weights_path, configure=True):
+    with _torch_lock:
+        _patch_torch_load()
+        from ultralytics import YOLO
+
+        loaded = YOLO(weights_path)
+        loaded.to(get_device())
+    if configure:
+        _configure_runtime([loaded])
+    return loaded
+
+def _configure_runtime(models):
+    """Threads / affinity / channels-last / bf16 cho inference trên CPU"""
+    global _runtime_profile
+    with _torch_lock:
+        from api.runtime import runtime_profile
+
+        runtime_profile.configure(models, get_device())
+        _runtime_profile = runtime_profile
+
+class ModelHandle:
+    """
+    Model được load khi cần. Gọi như YOLO: `handle(frame, conf=..., classes=[...])`.
+    """
+
+    def __init__(self, name, weights_path, stub_names, stub_kwargs=None, manifest=None):
+        self.name = name
+        self.weights_path = weights_path
+        self.stub_names = stub_names
+        self.stub_kwargs = stub_kwargs or {}
+        self.manifest = manifest or {}
+        self.load_seconds = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self, configure=True):
+        """configure=False: chưa áp dụng runtime profile (load_models sẽ tune chung)"""
+        if self._model is not None:
+            return self._model
+        with self._lock:
+            if self._model is None:
+                start = time.perf_counter()
+                if DETECTION_BACKEND == "stub":
+                    from api.stub_model import StubModel
+                    self._model = StubModel(self.stub_names, **self.stub_kwargs)
+                elif DETECTION_BACKEND == "onnx":
+                    from api.onnx_backend import OnnxYOLO
+                    self._model = OnnxYOLO(_onnx_path(self.weights_path, self.manifest), self.manifest.get("imgsz"))
+                else:
+                    self._model = _load_yolo(self.weights_path, configure)
+                self.load_seconds = round(time.perf_counter() - start, 3)
+                print(f"{self.name} model loaded ({DETECTION_BACKEND}) in {self.load_seconds}s")
+        return self._model
+
+    def __call__(self, *args, **kwargs):
+        loaded = self.load()
+        if _runtime_profile is not None:
+            return _runtime_profile.predict(loaded, *args, **kwargs)
+        return loaded(*args, **kwargs)
+
+    def info(self):
+        return {
+            "name": self.name,
+            "weights": os.path.basename(self.weights_path),
+            "loaded": self.loaded,
+            "load_seconds": self.load_seconds
+        }
+
+def load_models(handles):
+    """
+    Load nhiều model lúc khởi động (LAZY_MODELS=0). Với backend yolo, runtime
+    profile được autotune một lần trên tất cả model thay vì chỉ model load đầu tiên.
+    """
+    for handle in handles:
+        handle.load(configure=False)
+    if DETECTION_BACKEND == "yolo":
+        _configure_runtime([handle.load() for handle in handles])
+
+def models_info(handles):
+    """Thông tin backend + các model (dùng cho GET /models)"""
+    return {
+        "backend": DETECTION_BACKEND,
+        "lazy": LAZY_MODELS,
+        "device": _device,
+        "models": [handle.info() for handle in handles],
+        "runtime": _runtime_profile.summary() if _runtime_profile is not None else None
+    }
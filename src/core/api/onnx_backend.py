@@ -0,0 +1,118 @@
+import ast
+import os
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+
+from api.results import Boxes, Result
+
+# ============================================================
+# ONNX RUNTIME BACKEND (SLIM MODE)
+# ============================================================
+# Chạy model YOLOv8 đã export sang ONNX (badge_detection/train.py hoặc
+# `yolo export format=onnx`) chỉ với onnxruntime + OpenCV + numpy:
+# không cần torch, torchvision hay ultralytics.
+# Tiền xử lý / hậu xử lý giống ultralytics: ảnh numpy là BGR, letterbox
+# về imgsz, NMS theo từng class với iou=0.7.
+
+DEFAULT_IMGSZ = 640
+DEFAULT_CONF = 0.25
+DEFAULT_IOU = 0.7
+MAX_DET = 300
+MAX_WH = 7680
+
+def _session_options():
+    options = ort.SessionOptions()
+    threads = os.getenv("RUNTIME_THREADS", "auto")
+    if threads.isdigit():
+        options.intra_op_num_threads = int(threads)
+    options.inter_op_num_threads = int(os.getenv("RUNTIME_INTEROP_THREADS", "1"))
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+def letterbox(image, size):
+    """Resize giữ tỉ lệ + pad 114 về (size, size). Trả về (ảnh, ratio, (pad_x, pad_y))"""
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    new_w, new_h = int(round(width * ratio)), int(round(height * ratio))
+    pad_x, pad_y = (size - new_w) / 2, (size - new_h) / 2
+
+    if (new_w, new_h) != (width, height):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return image, ratio, (left, top)
+
+class OnnxYOLO:
+    """
+    YOLOv8 detection model chạy bằng onnxruntime, gọi giống YOLO:
+    `model(frame, conf=0.5, classes=[0])` -> [Result]
+    """
+
+    def __init__(self, path, imgsz=None):
+        self.path = path
+        self.session = ort.InferenceSession(path, _session_options(), providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+        shape = self.session.get_inputs()[0].shape
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if isinstance(shape[2], int):
+            self.imgsz = shape[2]
+        else:
+            self.imgsz = imgsz or int(ast.literal_eval(metadata.get("imgsz", f"[{DEFAULT_IMGSZ}]"))[0])
+        names = metadata.get("names")
+        self.names = ast.literal_eval(names) if names else {}
+
+    def to(self, device):
+        return self
+
+    def fuse(self):
+        return self
+
+    def __call__(self, image, conf=DEFAULT_CONF, classes=None, iou=DEFAULT_IOU, **kwargs):
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+
+        blob, ratio, (pad_x, pad_y) = letterbox(image, self.imgsz)
+        blob = cv2.cvtColor(blob, cv2.COLOR_BGR2RGB).transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+
+        # Output YOLOv8: (1, 4 + num_classes, num_anchors), box dạng cx, cy, w, h
+        preds = self.session.run(None, {self.input_name: blob})[0][0].T
+        scores = preds[:, 4:]
+        cls = scores.argmax(axis=1)
+        confidence = scores[np.arange(len(scores)), cls]
+
+        mask = confidence >= conf
+        if classes is not None:
+            mask &= np.isin(cls, classes)
+        preds, cls, confidence = preds[mask], cls[mask], confidence[mask]
+
+        xyxy = np.empty((len(preds), 4), dtype=np.float32)
+        xyxy[:, 0] = preds[:, 0] - preds[:, 2] / 2
+        xyxy[:, 1] = preds[:, 1] - preds[:, 3] / 2
+        xyxy[:, 2] = preds[:, 0] + preds[:, 2] / 2
+        xyxy[:, 3] = preds[:, 1] + preds[:, 3] / 2
+
+        if len(xyxy):
+            # NMS theo class: dịch box của mỗi class ra vùng riêng
+            offset = cls[:, None].astype(np.float32) * MAX_WH
+            shifted = xyxy + offset
+            keep = cv2.dnn.NMSBoxes(
+                np.column_stack([shifted[:, :2], shifted[:, 2:] - shifted[:, :2]]).tolist(),
+                confidence.tolist(), conf, iou
+            )
+            keep = np.array(keep, dtype=int).flatten()[:MAX_DET]
+            xyxy, cls, confidence = xyxy[keep], cls[keep], confidence[keep]
+
+            # Bỏ letterbox, đưa về toạ độ ảnh gốc
+            xyxy[:, [0, 2]] = (xyxy[:, [0, 2]] - pad_x) / ratio
+            xyxy[:, [1, 3]] = (xyxy[:, [1, 3]] - pad_y) / ratio
+            height, width = image.shape[:2]
+            xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, width)
+            xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, height)
+
+        return [Result(image, Boxes(xyxy, confidence, cls), self.names)]
@@ -0,0 +1,251 @@
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# ============================================================
+# EVIDENCE CLIP RECORDER (PRE-EVENT RING BUFFER)
+# ============================================================
+# Mỗi camera có một ring buffer các frame gốc đã nén JPEG trong RAM
+# (N giây gần nhất). Khi có sự kiện vi phạm (người không đeo badge),
+# recorder gom thêm vài giây sau sự kiện rồi chuyển cho thread nền ghi
+# clip (.avi MJPG) + keyframe đã annotate (.jpg) + metadata (.json).
+#
+# Cấu hình qua biến môi trường:
+# - RECORDER_ENABLED         (1/0, mặc định 1)
+# - RECORDER_DIR             (mặc định <core>/data/clips)
+# - RECORDER_PRE_SECONDS     (mặc định 5)
+# - RECORDER_POST_SECONDS    (mặc định 3)
+# - RECORDER_FPS             (fps lưu trong buffer, mặc định 10)
+# - RECORDER_JPEG_QUALITY    (mặc định 70)
+# - RECORDER_MAX_MEMORY_MB   (giới hạn RAM mỗi camera, mặc định 64)
+# - RECORDER_MAX_WRITE_MBPS  (giới hạn tốc độ ghi đĩa, mặc định 8, 0 = không giới hạn)
+# - RECORDER_COOLDOWN        (giây tối thiểu giữa 2 clip của một camera, mặc định 30)
+
+DEFAULT_CLIP_DIR = os.path.join(os.path.dirname(__file__), "..", "data", "clips")
+
+class _CameraBuffer:
+    """Ring buffer (timestamp, jpeg_bytes) của một camera"""
+
+    def __init__(self):
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.last_added = 0.0
+        self.pending = None
+        self.last_trigger = 0.0
+
+class ClipRecorder:
+    """
+    Ghi clip bằng chứng khi có sự kiện.
+    `add_frame()` và `trigger()` được gọi trong vòng lặp camera và chỉ tốn
+    một lần encode JPEG mỗi 1/fps giây; toàn bộ việc ghi đĩa chạy ở thread nền.
+    """
+
+    def __init__(self, clip_dir=DEFAULT_CLIP_DIR, pre_seconds=5.0, post_seconds=3.0, fps=10.0,
+                 jpeg_quality=70, max_memory_mb=64.0, max_write_mbps=8.0, cooldown=30.0,
+                 enabled=True):
+        self.clip_dir = os.path.abspath(clip_dir)
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.fps = fps
+        self.jpeg_quality = jpeg_quality
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.max_write_bps = max_write_mbps * 1024 * 1024
+        self.cooldown = cooldown
+        self.enabled = enabled
+
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=16)
+        self._thread = None
+        self.clips_written = 0
+        self.clips_dropped = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            clip_dir=os.getenv("RECORDER_DIR", DEFAULT_CLIP_DIR),
+            pre_seconds=float(os.getenv("RECORDER_PRE_SECONDS", "5")),
+            post_seconds=float(os.getenv("RECORDER_POST_SECONDS", "3")),
+            fps=float(os.getenv("RECORDER_FPS", "10")),
+            jpeg_quality=int(os.getenv("RECORDER_JPEG_QUALITY", "70")),
+            max_memory_mb=float(os.getenv("RECORDER_MAX_MEMORY_MB", "64")),
+            max_write_mbps=float(os.getenv("RECORDER_MAX_WRITE_MBPS", "8")),
+            cooldown=float(os.getenv("RECORDER_COOLDOWN", "30")),
+            enabled=os.getenv("RECORDER_ENABLED", "1") != "0"
+        )
+
+    def _buffer(self, camera):
+        key = str(camera)
+        buf = self._buffers.get(key)
+        if buf is None:
+            with self._lock:
+                buf = self._buffers.setdefault(key, _CameraBuffer())
+        return buf
+
+    # -------------------- hot path --------------------
+
+    def add_frame(self, camera, frame, now=None):
+        """Thêm frame gốc (BGR) vào ring buffer, lấy mẫu theo RECORDER_FPS"""
+        if not self.enabled:
+            return
+
+        now = time.time() if now is None else now
+        buf = self._buffer(camera)
+        if now - buf.last_added < 1.0 / self.fps:
+            return
+        buf.last_added = now
+
+        ret, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ret:
+            return
+        data = encoded.tobytes()
+
+        if buf.pending is not None:
+            buf.pending["frames"].append((now, data))
+            if now >= buf.pending["until"]:
+                self._submit(buf.pending)
+                buf.pending = None
+
+        buf.frames.append((now, data))
+        buf.bytes += len(data)
+        while buf.frames and (buf.bytes > self.max_memory or now - buf.frames[0][0] > self.pre_seconds):
+            _, old = buf.frames.popleft()
+            buf.bytes -= len(old)
+
+    def trigger(self, camera, keyframe, detections, reason="no_badge", now=None):
+        """
+        Đánh dấu sự kiện: chụp lại nội dung ring buffer hiện tại và
+        tiếp tục gom frame thêm RECORDER_POST_SECONDS giây.
+        """
+        if not self.enabled:
+            return False
+
+        now = time.time() if now is None else now
+        buf = self._buffer(camera)
+        if buf.pending is not None or now - buf.last_trigger < self.cooldown:
+            return False
+        buf.last_trigger = now
+
+        ret, encoded = cv2.imencode('.jpg', keyframe)
+        buf.pending = {
+            "camera": str(camera),
+            "timestamp": now,
+            "reason": reason,
+            "detections": detections,
+            "keyframe": encoded.tobytes() if ret else None,
+            "frames": [item for item in buf.frames if now - item[0] <= self.pre_seconds],
+            "until": now + self.post_seconds
+        }
+        return True
+
+    def flush(self, camera):
+        """Ghi ngay clip đang gom dở (khi stream của camera kết thúc)"""
+        buf = self._buffers.get(str(camera))
+        if buf is not None and buf.pending is not None:
+            self._submit(buf.pending)
+            buf.pending = None
+
+    def _submit(self, clip):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(clip)
+        except queue.Full:
+            self.clips_dropped += 1
+            print(f"Clip recorder queue full, dropping clip for camera {clip['camera']}")
+
+    # -------------------- background writer --------------------
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer_loop, name="clip-writer", daemon=True)
+                self._thread.start()
+
+    def _writer_loop(self):
+        while True:
+            clip = self._queue.get()
+            if clip is None:
+                break
+            try:
+                self._write_clip(clip)
+            except Exception as e:
+                print(f"Clip recorder write error: {e}")
+
+    def _throttle(self, start, written):
+        """Ngủ nếu tốc độ ghi vượt quá RECORDER_MAX_WRITE_MBPS"""
+        if self.max_write_bps <= 0:
+            return
+        expected = written / self.max_write_bps
+        elapsed = time.time() - start
+        if expected > elapsed:
+            time.sleep(expected - elapsed)
+
+    def _write_clip(self, clip):
+        frames = clip["frames"]
+        if not frames:
+            return
+
+        camera_dir = os.path.join(self.clip_dir, clip["camera"])
+        os.makedirs(camera_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(clip["timestamp"]))
+        base = os.path.join(camera_dir, f"{stamp}_{clip['reason']}")
+
+        first = cv2.imdecode(np.frombuffer(frames[0][1], np.uint8), cv2.IMREAD_COLOR)
+        height, width = first.shape[:2]
+        duration = max(frames[-1][0] - frames[0][0], 1e-3)
+        fps = max(1.0, min(self.fps, (len(frames) - 1) / duration)) if len(frames) > 1 else self.fps
+
+        start = time.time()
+        written = 0
+        writer = cv2.VideoWriter(base + ".avi", cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+        try:
+            for _, data in frames:
+                frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+                if frame.shape[:2] != (height, width):
+                    frame = cv2.resize(frame, (width, height))
+                writer.write(frame)
+                written += len(data)
+                self._throttle(start, written)
+        finally:
+            writer.release()
+
+        if clip["keyframe"] is not None:
+            with open(base + "_keyframe.jpg", "wb") as f:
+                f.write(clip["keyframe"])
+
+        with open(base + ".json", "w") as f:
+            json.dump({
+                "camera": clip["camera"],
+                "timestamp": clip["timestamp"],
+                "reason": clip["reason"],
+                "frames": len(frames),
+                "start": frames[0][0],
+                "end": frames[-1][0],
+                "detections": clip["detections"]
+            }, f)
+
+        self.clips_written += 1
+        print(f"Evidence clip saved: {base}.avi ({len(frames)} frames)")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "clip_dir": self.clip_dir,
+            "buffers": {
+                camera: {"frames": len(buf.frames), "bytes": buf.bytes, "recording": buf.pending is not None}
+                for camera, buf in list(self._buffers.items())
+            },
+            "clips_written": self.clips_written,
+            "clips_dropped": self.clips_dropped
+        }
+
+# Global clip recorder
+clip_recorder = ClipRecorder.from_env()
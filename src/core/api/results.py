@@ -0,0 +1,67 @@
+import numpy as np
+import cv2
+
+# ============================================================
+# LIGHTWEIGHT DETECTION RESULTS
+# ============================================================
+# Cấu trúc kết quả tối giản có cùng interface với ultralytics Results mà
+# api/functions.py sử dụng (results[0].boxes.xyxy/conf/cls, .plot(), .names,
+# results[0][indices] để giữ một phần box).
+# Dùng bởi các backend không cần torch: ONNX Runtime và stub model.
+
+class Array:
+    """Bọc numpy array để giống tensor: .cpu().numpy(), index, len"""
+
+    def __init__(self, data):
+        self._data = np.asarray(data, dtype=np.float32)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._data
+
+    def __getitem__(self, index):
+        return Array(self._data[index])
+
+    def __len__(self):
+        return len(self._data)
+
+class Boxes:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = Array(np.reshape(xyxy, (-1, 4)))
+        self.conf = Array(conf)
+        self.cls = Array(cls)
+        self.data = Array(np.concatenate([self.xyxy.numpy(), self.conf.numpy()[:, None], self.cls.numpy()[:, None]], axis=1))
+
+    def __len__(self):
+        return len(self.conf)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield Boxes(self.xyxy.numpy()[i:i + 1], self.conf.numpy()[i:i + 1], self.cls.numpy()[i:i + 1])
+
+    def __getitem__(self, index):
+        """Boxes con theo slice / list index / mask (giống ultralytics Boxes)"""
+        return Boxes(self.xyxy.numpy()[index], self.conf.numpy()[index], self.cls.numpy()[index])
+
+class Result:
+    def __init__(self, image, boxes, names):
+        self.orig_img = image
+        self.boxes = boxes
+        self.names = names
+
+    def __getitem__(self, index):
+        """Result chỉ giữ các box được chọn (giống results[0][indices] của ultralytics)"""
+        return Result(self.orig_img, self.boxes[index], self.names)
+
+    def plot(self):
+        """Vẽ box + label lên bản copy của ảnh gốc"""
+        annotated = self.orig_img.copy()
+        for (x1, y1, x2, y2), conf, cls in zip(self.boxes.xyxy.numpy().astype(int),
+                                                self.boxes.conf.numpy(), self.boxes.cls.numpy()):
+            cv2.rectangle(annotated, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            label = f"{self.names.get(int(cls), int(cls))} {conf:.2f}"
+            cv2.putText(annotated, label, (x1, max(0, y1 - 10)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        return annotated
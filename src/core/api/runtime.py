@@ -0,0 +1,338 @@
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+# ============================================================
+# CPU RUNTIME PROFILE (THREADS, AFFINITY, PRECISION)
+# ============================================================
+# Mặc định PyTorch dùng tất cả core cho intra-op và inter-op threads của
+# mỗi process. Khi chạy nhiều uvicorn worker + 2 model trên một máy, các
+# thread tranh nhau core và throughput giảm. Module này:
+# - giới hạn số thread torch/OpenMP cho mỗi worker
+# - pin mỗi worker vào một nhóm core riêng (Linux)
+# - bật channels-last, Conv+BN fusion và bf16 autocast khi CPU hỗ trợ
+# - auto-tune lúc khởi động, lưu cấu hình nhanh nhất vào file JSON
+#
+# Cấu hình qua biến môi trường:
+# - RUNTIME_WORKERS          (số uvicorn worker trên máy, mặc định 1)
+# - RUNTIME_CPU_AFFINITY     ("" = không pin, "auto" = chia core theo worker, hoặc "0-3,6")
+# - RUNTIME_THREADS          (số intra-op threads, "auto" = theo core được cấp)
+# - RUNTIME_INTEROP_THREADS  (mặc định 1)
+# - RUNTIME_CHANNELS_LAST    (auto | 1 | 0, mặc định auto)
+# - RUNTIME_BF16             (auto | 1 | 0, mặc định auto)
+# - RUNTIME_AUTOTUNE         (1/0, mặc định 1)
+# - RUNTIME_PROFILE_PATH     (mặc định <core>/data/runtime_profile.json)
+
+DEFAULT_PROFILE_PATH = os.path.join(os.path.dirname(__file__), "..", "data", "runtime_profile.json")
+TUNE_IMGSZ = 640
+TUNE_WARMUP = 2
+TUNE_RUNS = 8
+
+def parse_cpu_list(value):
+    """Parse "0-3,6" thành [0, 1, 2, 3, 6]"""
+    cores = []
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def cpu_supports_bf16():
+    """bf16 chỉ nhanh hơn khi CPU có AVX512-BF16 hoặc AMX"""
+    if not torch.backends.mkldnn.is_available():
+        return False
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+def _env_choice(name, default="auto"):
+    value = os.getenv(name, default).strip().lower()
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    return None
+
+class RuntimeProfile:
+    """
+    Cấu hình runtime cho inference trên CPU của process hiện tại.
+    """
+
+    def __init__(self):
+        self.workers = int(os.getenv("RUNTIME_WORKERS", "1"))
+        self.affinity = os.getenv("RUNTIME_CPU_AFFINITY", "").strip()
+        self.threads = os.getenv("RUNTIME_THREADS", "auto").strip()
+        self.interop_threads = int(os.getenv("RUNTIME_INTEROP_THREADS", "1"))
+        self.channels_last = _env_choice("RUNTIME_CHANNELS_LAST")
+        self.bf16 = _env_choice("RUNTIME_BF16")
+        self.autotune = os.getenv("RUNTIME_AUTOTUNE", "1") != "0"
+        self.profile_path = os.path.abspath(os.getenv("RUNTIME_PROFILE_PATH", DEFAULT_PROFILE_PATH))
+
+        self.device = "cpu"
+        self.slot = 0
+        self.cores = []
+        self.active = {}
+        self.tuning = []
+        self.configured = False
+        self.tuned_models = []
+        self._slot_file = None
+
+    # -------------------- threads + affinity --------------------
+
+    def _claim_worker_slot(self):
+        """
+        Mỗi worker process giữ một file lock để biết mình là worker số mấy
+        (lock tự giải phóng khi process kết thúc).
+        """
+        try:
+            import fcntl
+        except ImportError:
+            return 0
+        for slot in range(self.workers):
+            path = os.path.join(tempfile.gettempdir(), f"badge-runtime-slot-{slot}.lock")
+            f = open(path, "w")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            self._slot_file = f
+            return slot
+        return 0
+
+    def _apply_affinity(self):
+        cores = available_cores()
+        if not self.affinity:
+            self.cores = cores
+            return
+
+        if self.affinity == "auto":
+            self.slot = self._claim_worker_slot()
+            chunk = max(1, len(cores) // max(1, self.workers))
+            selected = cores[self.slot * chunk:(self.slot + 1) * chunk] or cores
+        else:
+            selected = parse_cpu_list(self.affinity)
+
+        if hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, selected)
+                print(f"Runtime: worker slot {self.slot} pinned to cores {selected}")
+            except OSError as e:
+                print(f"Runtime: cannot set CPU affinity {selected}: {e}")
+                selected = cores
+        self.cores = selected
+
+    def _default_threads(self):
+        if self.threads != "auto":
+            return int(self.threads)
+        if self.affinity:
+            return max(1, len(self.cores))
+        return max(1, len(self.cores) // max(1, self.workers))
+
+    def _apply_threads(self, threads):
+        # set_num_threads cũng set OpenMP / MKL threads của process; biến môi trường
+        # OMP_NUM_THREADS chỉ có tác dụng trước khi import torch nên không set ở đây
+        torch.set_num_threads(threads)
+
+    # -------------------- precision / layout --------------------
+
+    @staticmethod
+    def _set_channels_last(models, enabled):
+        fmt = torch.channels_last if enabled else torch.contiguous_format
+        for m in models:
+            m.model.to(memory_format=fmt)
+
+    def predict(self, model, *args, **kwargs):
+        """
+        Gọi model với profile hiện tại. Với bf16 autocast, box trả về là tensor bf16
+        (không .numpy() được) nên kết quả được đưa về float32.
+        """
+        if not self.active.get("bf16"):
+            return model(*args, **kwargs)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            results = model(*args, **kwargs)
+        return [result.to(torch.float32) for result in results]
+
+    # -------------------- auto-tuning --------------------
+
+    @staticmethod
+    def _model_names(models):
+        """Tên weights của các model được tune (một phần của profile key)"""
+        names = []
+        for m in models:
+            path = getattr(m, "ckpt_path", None) or getattr(m, "model_name", None) or type(m).__name__
+            names.append(os.path.basename(str(path)))
+        return sorted(names)
+
+    def _profile_key(self, models):
+        return "|".join([
+            platform.processor() or platform.machine(),
+            f"cores={len(self.cores)}",
+            f"workers={self.workers}",
+            f"torch={torch.__version__}",
+            "models=" + ",".join(self._model_names(models))
+        ])
+
+    def _load_cached(self, models):
+        if not os.path.exists(self.profile_path):
+            return None
+        try:
+            with open(self.profile_path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return cached.get(self._profile_key(models))
+
+    def _save_cached(self, models, result):
+        cached = {}
+        if os.path.exists(self.profile_path):
+            try:
+                with open(self.profile_path) as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                cached = {}
+        cached[self._profile_key(models)] = result
+        os.makedirs(os.path.dirname(self.profile_path), exist_ok=True)
+        with open(self.profile_path, "w") as f:
+            json.dump(cached, f, indent=2)
+
+    def _measure(self, models, img):
+        """Tổng latency trung vị (ms) của tất cả models trên một ảnh"""
+        total = 0.0
+        for m in models:
+            for _ in range(TUNE_WARMUP):
+                results = self.predict(m, img, verbose=False)
+            # Kết quả phải convert được sang numpy như trong functions.py
+            results[0].boxes.data.cpu().numpy()
+            timings = []
+            for _ in range(TUNE_RUNS):
+                start = time.perf_counter()
+                self.predict(m, img, verbose=False)
+                timings.append((time.perf_counter() - start) * 1000)
+            total += float(np.median(timings))
+        return total
+
+    def _candidates(self, default_threads):
+        thread_options = sorted({default_threads, max(1, default_threads // 2), max(1, default_threads // 4)}, reverse=True)
+        if self.threads != "auto":
+            thread_options = [default_threads]
+        channels_options = [False, True] if self.channels_last is None else [self.channels_last]
+        bf16_supported = cpu_supports_bf16()
+        if self.bf16 is None:
+            bf16_options = [False, True] if bf16_supported else [False]
+        else:
+            bf16_options = [self.bf16 and bf16_supported]
+        return [
+            {"threads": t, "channels_last": c, "bf16": b}
+            for t in thread_options for c in channels_options for b in bf16_options
+        ]
+
+    def _tune(self, models, default_threads):
+        img = np.random.randint(0, 255, (TUNE_IMGSZ, TUNE_IMGSZ, 3), dtype=np.uint8)
+        best = None
+        for candidate in self._candidates(default_threads):
+            self._activate(models, candidate)
+            try:
+                latency = self._measure(models, img)
+            except Exception as e:
+                print(f"Runtime autotune: {candidate} failed: {e}")
+                continue
+            self.tuning.append(dict(candidate, latency_ms=round(latency, 2)))
+            print(f"Runtime autotune: {candidate} -> {latency:.1f} ms")
+            if best is None or latency < best[1]:
+                best = (candidate, latency)
+        if best is None:
+            return {"threads": default_threads, "channels_last": False, "bf16": False}
+        return dict(best[0], latency_ms=round(best[1], 2))
+
+    def _activate(self, models, config):
+        self._apply_threads(config["threads"])
+        self._set_channels_last(models, config["channels_last"])
+        self.active = dict(config)
+
+    # -------------------- entry point --------------------
+
+    def configure(self, models, device):
+        """
+        Áp dụng profile cho các YOLO models. Chỉ có tác dụng trên CPU.
+        Lần gọi đầu tiên nên truyền tất cả model load lúc khởi động để autotune
+        đo trên toàn bộ; model load sau (LAZY_MODELS) chỉ được áp dụng profile đã chọn.
+        """
+        if self.configured:
+            # Process đã được cấu hình (model load sau, LAZY_MODELS): chỉ áp dụng layout
+            for m in models:
+                m.fuse()
+            self._set_channels_last(models, self.active.get("channels_last", False))
+            return self.summary()
+        self.configured = True
+        self.tuned_models = self._model_names(models)
+
+        self.device = device
+        if device != "cpu":
+            print(f"Runtime: device={device}, skipping CPU tuning")
+            return self.summary()
+
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError as e:
+            # Chỉ set được trước khi có inter-op work đầu tiên
+            print(f"Runtime: cannot set inter-op threads: {e}")
+
+        self._apply_affinity()
+
+        # Ultralytics cũng fuse khi predict lần đầu; fuse ở đây để benchmark đúng
+        for m in models:
+            m.fuse()
+
+        default_threads = self._default_threads()
+        config = {
+            "threads": default_threads,
+            "channels_last": bool(self.channels_last),
+            "bf16": bool(self.bf16) and cpu_supports_bf16()
+        }
+
+        if self.autotune:
+            cached = self._load_cached(models)
+            if cached is not None:
+                print(f"Runtime: using cached profile {cached}")
+                config = cached
+            else:
+                config = self._tune(models, default_threads)
+                self._save_cached(models, config)
+
+        self._activate(models, config)
+        print(f"Runtime profile: {self.summary()}")
+        return self.summary()
+
+    def summary(self):
+        return {
+            "device": self.device,
+            "workers": self.workers,
+            "worker_slot": self.slot,
+            "cores": self.cores,
+            "interop_threads": self.interop_threads,
+            "active": self.active,
+            "tuned_models": self.tuned_models,
+            "tuning": self.tuning
+        }
+
+# Global runtime profile
+runtime_profile = RuntimeProfile()
@@ -0,0 +1,308 @@
+import asyncio
+import collections
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+# ============================================================
+# QOS SCHEDULER: PRIORITY CLASSES, DEADLINES, RATE LIMITING
+# ============================================================
+# Live stream, snapshot và upload cùng dùng chung hai model. Mọi lần gọi
+# inference đều phải lấy một slot từ `scheduler`:
+# - live        : frame của /camera|badge|combined/stream và /events
+# - interactive : snapshot, upload từ UI
+# - bulk        : upload hàng loạt / audit (header X-Priority: bulk)
+# Khi có slot trống, class ưu tiên cao hơn được chọn trước; trong một class
+# phục vụ theo thứ tự đến. Mỗi class có giới hạn concurrency riêng: bulk mặc
+# định chỉ chiếm 1 slot nên live luôn còn chỗ, còn bulk dùng phần dư.
+# Request chờ quá deadline bị bỏ (live: bỏ frame, đọc frame mới hơn;
+# interactive / bulk: trả 503) thay vì chạy trễ.
+#
+# Upload chờ slot bằng `async_slot` trên event loop, không chiếm thread của
+# threadpool (MJPEG generator cũng chạy trên threadpool đó). Hàng đợi của mỗi
+# class có giới hạn: đầy thì trả 503 ngay thay vì xếp hàng thêm.
+#
+# Cấu hình qua biến môi trường:
+# - QOS_MAX_CONCURRENCY           (tổng số inference chạy song song, mặc định 2)
+# - QOS_<CLASS>_CONCURRENCY       (LIVE / INTERACTIVE / BULK, mặc định 2 / 2 / 1)
+# - QOS_<CLASS>_DEADLINE_MS       (thời gian chờ tối đa, mặc định 200 / 2000 / 30000)
+# - QOS_<CLASS>_MAX_WAITING       (số request chờ tối đa, mặc định 0 (không giới hạn) / 8 / 32)
+# - QOS_RATE_LIMIT                (request/giây cho mỗi API key, mặc định 0 = tắt)
+# - QOS_RATE_BURST                (mặc định 2 x QOS_RATE_LIMIT)
+# - QOS_API_KEYS                  ("key:class,..." = class cao nhất mỗi key được dùng)
+
+QOS_CLASSES = ("live", "interactive", "bulk")
+
+DEFAULT_CONCURRENCY = {"live": 2, "interactive": 2, "bulk": 1}
+DEFAULT_DEADLINE_MS = {"live": 200, "interactive": 2000, "bulk": 30000}
+DEFAULT_MAX_WAITING = {"live": 0, "interactive": 8, "bulk": 32}
+
+class QosError(Exception):
+    status_code = 503
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class DeadlineExceeded(QosError):
+    status_code = 503
+
+class QueueFull(QosError):
+    status_code = 503
+
+class RateLimited(QosError):
+    status_code = 429
+
+class InvalidQosHeader(QosError):
+    status_code = 400
+
+def lower_priority(*classes):
+    """Class có độ ưu tiên thấp nhất trong các class (bỏ qua None)"""
+    return max((c for c in classes if c), key=QOS_CLASSES.index)
+
+class _Ticket:
+    """Một request đang chờ slot. wake() được gọi (trong lock) khi được cấp slot"""
+
+    def __init__(self, qos, wake):
+        self.qos = qos
+        self.wake = wake
+        self.granted = False
+
+class InferenceScheduler:
+    """
+    Semaphore có ưu tiên cho inference. Slot được cấp trực tiếp cho waiter
+    (thread hoặc asyncio task) khi có slot trống.
+
+        with scheduler.slot("bulk", deadline=time.time() + 5):
+            results = model(frame)
+
+        async with scheduler.async_slot("bulk"):
+            await run_in_threadpool(...)
+    """
+
+    def __init__(self):
+        self.max_concurrency = int(os.getenv("QOS_MAX_CONCURRENCY", "2"))
+        self.limits = {}
+        self.deadlines = {}
+        self.max_waiting = {}
+        for name in QOS_CLASSES:
+            key = name.upper()
+            self.limits[name] = int(os.getenv(f"QOS_{key}_CONCURRENCY", str(DEFAULT_CONCURRENCY[name])))
+            self.deadlines[name] = float(os.getenv(f"QOS_{key}_DEADLINE_MS", str(DEFAULT_DEADLINE_MS[name]))) / 1000
+            self.max_waiting[name] = int(os.getenv(f"QOS_{key}_MAX_WAITING", str(DEFAULT_MAX_WAITING[name])))
+
+        self._lock = threading.Lock()
+        self._waiting = {name: collections.deque() for name in QOS_CLASSES}
+        self._running = {name: 0 for name in QOS_CLASSES}
+        self._total_running = 0
+        self._counters = {name: {"admitted": 0, "dropped": 0, "rejected": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+                          for name in QOS_CLASSES}
+
+    def deadline_for(self, qos, deadline_ms=None):
+        """Deadline tuyệt đối (time.time()) cho request mới của class qos"""
+        timeout = deadline_ms / 1000 if deadline_ms is not None else self.deadlines[qos]
+        return time.time() + timeout
+
+    # -------------------- queue (phải giữ self._lock) --------------------
+
+    def _dispatch(self):
+        """Cấp slot trống cho waiter: class ưu tiên cao trước, FIFO trong class"""
+        while self._total_running < self.max_concurrency:
+            for name in QOS_CLASSES:
+                if self._waiting[name] and self._running[name] < self.limits[name]:
+                    ticket = self._waiting[name].popleft()
+                    ticket.granted = True
+                    self._running[name] += 1
+                    self._total_running += 1
+                    ticket.wake()
+                    break
+            else:
+                return
+
+    def _enqueue(self, qos, wake):
+        if qos not in self._waiting:
+            raise ValueError(f"Invalid priority class: {qos}")
+        limit = self.max_waiting[qos]
+        if limit and len(self._waiting[qos]) >= limit:
+            self._counters[qos]["rejected"] += 1
+            raise QueueFull(f"{qos} queue is full", retry_after=self.deadlines[qos])
+        ticket = _Ticket(qos, wake)
+        self._waiting[qos].append(ticket)
+        self._dispatch()
+        return ticket
+
+    def _abandon(self, ticket):
+        """Waiter bỏ cuộc (lỗi / bị cancel): trả slot nếu đã được cấp, ngược lại rời hàng đợi"""
+        if ticket.granted:
+            self._running[ticket.qos] -= 1
+            self._total_running -= 1
+            self._dispatch()
+        elif ticket in self._waiting[ticket.qos]:
+            self._waiting[ticket.qos].remove(ticket)
+
+    def _finish_wait(self, ticket, start):
+        """Sau khi chờ: ghi nhận nếu được cấp slot, ngược lại rời hàng đợi và raise"""
+        counters = self._counters[ticket.qos]
+        if not ticket.granted:
+            self._waiting[ticket.qos].remove(ticket)
+            counters["dropped"] += 1
+            raise DeadlineExceeded(f"{ticket.qos} request missed its deadline in queue",
+                                   retry_after=self.deadlines[ticket.qos])
+        waited = (time.time() - start) * 1000
+        counters["admitted"] += 1
+        counters["wait_ms_total"] += waited
+        counters["wait_ms_max"] = max(counters["wait_ms_max"], waited)
+
+    # -------------------- thread API --------------------
+
+    def acquire(self, qos, deadline=None):
+        """
+        Chờ slot cho class qos (block thread hiện tại). Raise DeadlineExceeded nếu
+        đến deadline (time.time()) vẫn chưa được chạy, QueueFull nếu hàng đợi đầy.
+        """
+        deadline = deadline if deadline is not None else self.deadline_for(qos)
+        start = time.time()
+        event = threading.Event()
+        with self._lock:
+            ticket = self._enqueue(qos, event.set)
+        try:
+            if not ticket.granted:
+                event.wait(max(0.0, deadline - time.time()))
+        except BaseException:
+            with self._lock:
+                self._abandon(ticket)
+            raise
+        with self._lock:
+            self._finish_wait(ticket, start)
+
+    def release(self, qos):
+        with self._lock:
+            self._running[qos] -= 1
+            self._total_running -= 1
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, qos, deadline=None):
+        """qos=None: caller đã giữ slot (async_slot trong endpoint), không lấy thêm"""
+        if qos is None:
+            yield
+            return
+        self.acquire(qos, deadline)
+        try:
+            yield
+        finally:
+            self.release(qos)
+
+    # -------------------- asyncio API --------------------
+
+    async def acquire_async(self, qos, deadline=None):
+        """Như acquire() nhưng chờ trên event loop, không chiếm thread"""
+        deadline = deadline if deadline is not None else self.deadline_for(qos)
+        start = time.time()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._lock:
+            ticket = self._enqueue(qos, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            if not ticket.granted:
+                await asyncio.wait_for(event.wait(), max(0.0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            # Client ngắt kết nối khi đang chờ: trả slot nếu đã được cấp
+            with self._lock:
+                self._abandon(ticket)
+            raise
+        with self._lock:
+            self._finish_wait(ticket, start)
+
+    @asynccontextmanager
+    async def async_slot(self, qos, deadline=None):
+        await self.acquire_async(qos, deadline)
+        try:
+            yield
+        finally:
+            self.release(qos)
+
+    def stats(self):
+        with self._lock:
+            classes = {}
+            for name in QOS_CLASSES:
+                counters = self._counters[name]
+                admitted = counters["admitted"]
+                classes[name] = {
+                    "concurrency": self.limits[name],
+                    "deadline_ms": self.deadlines[name] * 1000,
+                    "max_waiting": self.max_waiting[name],
+                    "running": self._running[name],
+                    "waiting": len(self._waiting[name]),
+                    "admitted": admitted,
+                    "dropped": counters["dropped"],
+                    "rejected": counters["rejected"],
+                    "avg_wait_ms": round(counters["wait_ms_total"] / admitted, 2) if admitted else 0.0,
+                    "max_wait_ms": round(counters["wait_ms_max"], 2)
+                }
+            return {"max_concurrency": self.max_concurrency, "running": self._total_running, "classes": classes}
+
+class RateLimiter:
+    """Token bucket cho mỗi API key (hoặc IP client nếu không có key)"""
+
+    def __init__(self):
+        self.rate = float(os.getenv("QOS_RATE_LIMIT", "0"))
+        self.burst = float(os.getenv("QOS_RATE_BURST", str(max(1.0, 2 * self.rate))))
+        self.key_classes = {}
+        for item in os.getenv("QOS_API_KEYS", "").split(","):
+            if ":" in item:
+                key, qos = item.rsplit(":", 1)
+                if qos.strip() in QOS_CLASSES:
+                    self.key_classes[key.strip()] = qos.strip()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.time()
+        self.rejected = 0
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def check(self, key):
+        """Lấy một token cho key, raise RateLimited nếu hết"""
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.rejected += 1
+                raise RateLimited(f"Rate limit exceeded for {key}", retry_after=(1 - tokens) / self.rate)
+            self._buckets[key] = (tokens - 1, now)
+
+    def _prune(self, now):
+        """
+        Bỏ bucket đã đầy lại (không request trong burst / rate giây): giống hệt key
+        chưa gặp, nên không giữ một entry cho mỗi IP client mãi mãi (phải giữ self._lock)
+        """
+        refill = self.burst / self.rate
+        if now - self._last_prune < refill:
+            return
+        self._last_prune = now
+        for key in [k for k, (_, last) in self._buckets.items() if now - last >= refill]:
+            del self._buckets[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "rate": self.rate,
+                "burst": self.burst,
+                "keys": len(self._buckets),
+                "rejected": self.rejected
+            }
+
+# Global instances
+scheduler = InferenceScheduler()
+rate_limiter = RateLimiter()
@@ -0,0 +1,57 @@
+import os
+import threading
+import time
+
+# ============================================================
+# SNAPSHOT DETECTION CACHE
+# ============================================================
+# Live stream (và chính snapshot) ghi lại kết quả detect gần nhất của mỗi
+# (source, kind). /camera/snapshot và /badge/snapshot dùng lại kết quả này
+# nếu đủ mới thay vì chạy model lần nữa trên gần như cùng một frame.
+#
+# Cấu hình qua biến môi trường:
+# - SNAPSHOT_MAX_AGE_MS  (tuổi tối đa của kết quả được dùng lại, mặc định 500, 0 = tắt)
+
+class SnapshotCache:
+    """
+    Kết quả detect gần nhất theo (source, kind): results[0] (để vẽ lại bằng .plot())
+    và detections dict. Chỉ dùng lại khi cùng confidence threshold.
+    """
+
+    def __init__(self):
+        self.max_age = float(os.getenv("SNAPSHOT_MAX_AGE_MS", "500")) / 1000
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, source, kind, result, detections, confidence):
+        if self.max_age <= 0:
+            return
+        with self._lock:
+            self._entries[(str(source), kind)] = (time.time(), result, detections, confidence)
+
+    def get(self, source, kind, confidence):
+        """Trả về (result, detections, age_seconds) hoặc None nếu không có / quá cũ"""
+        with self._lock:
+            entry = self._entries.get((str(source), kind))
+            if entry is not None:
+                captured_at, result, detections, cached_confidence = entry
+                age = time.time() - captured_at
+                if age <= self.max_age and abs(cached_confidence - confidence) < 1e-6:
+                    self.hits += 1
+                    return result, detections, age
+            self.misses += 1
+            return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_age_ms": self.max_age * 1000,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+# Global instance
+snapshot_cache = SnapshotCache()
@@ -0,0 +1,197 @@
+import queue
+import time
+import cv2
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+
+# ============================================================
+# ADAPTIVE MJPEG STREAMING (PER VIEWER)
+# ============================================================
+# Mỗi client MJPEG có một AdaptiveStream riêng. Thời gian client "drain"
+# socket (thời gian từ lúc yield một frame đến lúc generator được gọi lại)
+# được dùng để điều chỉnh JPEG quality, độ phân giải và FPS.
+# Camera và model chạy trong detection loop riêng (api/events.py): viewer chỉ
+# lấy frame đã annotate mới nhất và encode theo cấu hình của chính nó.
+# ClosingStreamingResponse đóng generator khi client ngắt kết nối để viewer
+# unsubscribe ngay: loop dừng khi không còn subscriber và capture được đóng
+# sau CAMERA_IDLE_TIMEOUT.
+
+MIN_QUALITY = 40
+QUALITY_STEP = 10
+MIN_SCALE = 0.25
+SCALE_STEP = 0.75
+MIN_FPS = 1.0
+FPS_STEP = 0.5
+
+class AdaptiveStream:
+    """
+    Điều khiển bitrate cho một viewer MJPEG.
+
+    Thứ tự giảm chất lượng khi client chậm: quality -> resolution -> FPS.
+    Khi client nhanh trở lại thì tăng theo thứ tự ngược lại, không vượt quá các giới hạn
+    (max_quality, max_width, max_fps) do client truyền qua query.
+    """
+
+    def __init__(self, max_quality=95, max_width=None, max_fps=30.0, adaptive=True,
+                 adjust_every=5, smoothing=0.3):
+        self.max_quality = max_quality
+        self.max_width = max_width
+        self.max_fps = max_fps
+        self.adaptive = adaptive
+        self.adjust_every = adjust_every
+        self.smoothing = smoothing
+
+        self.quality = max_quality
+        self.scale = 1.0
+        self.fps = max_fps
+
+        self.drain_ewma = None
+        self.last_sent = 0.0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self._since_adjust = 0
+
+    def should_send(self, now=None):
+        """
+        Trả về False nếu frame này nên bị bỏ qua để giữ đúng FPS hiện tại
+        (client đang chậm hoặc vượt quá max_fps).
+        """
+        now = time.time() if now is None else now
+        if self.fps and now - self.last_sent < 1.0 / self.fps:
+            self.frames_skipped += 1
+            return False
+        self.last_sent = now
+        return True
+
+    def encode(self, frame):
+        """Resize (nếu cần) và encode frame thành JPEG theo cấu hình hiện tại"""
+        height, width = frame.shape[:2]
+        scale = self.scale
+        if self.max_width and width > self.max_width:
+            scale *= self.max_width / width
+
+        if scale < 1.0:
+            frame = cv2.resize(frame, (max(1, int(width * scale)), max(1, int(height * scale))),
+                               interpolation=cv2.INTER_AREA)
+
+        ret, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(self.quality)])
+        if not ret:
+            return None
+        return buffer.tobytes()
+
+    def record_drain(self, seconds):
+        """
+        Ghi nhận thời gian client nhận xong một frame và điều chỉnh cấu hình nếu cần
+        """
+        self.frames_sent += 1
+        if self.drain_ewma is None:
+            self.drain_ewma = seconds
+        else:
+            self.drain_ewma = self.smoothing * seconds + (1 - self.smoothing) * self.drain_ewma
+
+        if not self.adaptive:
+            return
+
+        self._since_adjust += 1
+        if self._since_adjust < self.adjust_every:
+            return
+        self._since_adjust = 0
+
+        budget = 1.0 / self.fps if self.fps else 1.0 / self.max_fps
+        if self.drain_ewma > 0.8 * budget:
+            self._degrade()
+        elif self.drain_ewma < 0.3 * budget:
+            self._upgrade()
+
+    def _degrade(self):
+        if self.quality > MIN_QUALITY:
+            self.quality = max(MIN_QUALITY, self.quality - QUALITY_STEP)
+        elif self.scale > MIN_SCALE:
+            self.scale = max(MIN_SCALE, self.scale * SCALE_STEP)
+        elif self.fps > MIN_FPS:
+            self.fps = max(MIN_FPS, self.fps * FPS_STEP)
+
+    def _upgrade(self):
+        if self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps / FPS_STEP)
+        elif self.scale < 1.0:
+            self.scale = min(1.0, self.scale / SCALE_STEP)
+        elif self.quality < self.max_quality:
+            self.quality = min(self.max_quality, self.quality + QUALITY_STEP)
+
+    def stats(self):
+        """Trạng thái hiện tại (dùng cho log / debug)"""
+        return {
+            "quality": self.quality,
+            "scale": round(self.scale, 3),
+            "fps": round(self.fps, 2),
+            "drain_ms": round(self.drain_ewma * 1000, 1) if self.drain_ewma is not None else None,
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped
+        }
+
+def mjpeg_frames(subscription, adaptive, poll=1.0):
+    """
+    Multipart MJPEG cho một viewer: lấy frame đã annotate mới nhất từ detection loop
+    (subscription chỉ giữ một item), encode theo AdaptiveStream của viewer và đo thời
+    gian drain của client sau mỗi frame. Trong lúc client chậm, loop vẫn chạy và
+    frame cũ bị thay bằng frame mới trong queue của viewer.
+    """
+    try:
+        while True:
+            try:
+                item = subscription.get(timeout=poll)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            if item["frame"] is None or not adaptive.should_send():
+                continue
+            frame_bytes = adaptive.encode(item["frame"])
+            if frame_bytes is None:
+                continue
+            start = time.time()
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            adaptive.record_drain(time.time() - start)
+            # Loop chỉ cần xử lý theo FPS hiện tại của viewer (đã giảm nếu client chậm)
+            subscription.max_fps = adaptive.fps
+    finally:
+        subscription.close()
+
+_END = object()
+
+async def _close_when_done(iterator):
+    """
+    Chạy generator đồng bộ trên threadpool (như Starlette) nhưng luôn gọi close()
+    khi response kết thúc, kể cả khi client ngắt kết nối giữa chừng
+    """
+    try:
+        while True:
+            chunk = await run_in_threadpool(next, iterator, _END)
+            if chunk is _END:
+                break
+            yield chunk
+    finally:
+        # Không await ở đây: task có thể đang bị cancel. close() chỉ chạy các
+        # finally của generator (unsubscribe), generator không chạy ở thread khác
+        iterator.close()
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse cho MJPEG / event stream dài hạn.
+
+    Với ASGI spec >= 2.4 (uvicorn), khi client đóng kết nối Starlette chỉ nhận OSError
+    từ send() và bỏ body iterator ở trạng thái treo: generator không bao giờ được đóng,
+    subscription vẫn còn nên detection loop và camera chạy mãi. Class này đóng iterator
+    trong mọi trường hợp kết thúc.
+    """
+
+    def __init__(self, content, *args, **kwargs):
+        super().__init__(_close_when_done(iter(content)), *args, **kwargs)
+
+    async def stream_response(self, send):
+        try:
+            await super().stream_response(send)
+        finally:
+            await self.body_iterator.aclose()
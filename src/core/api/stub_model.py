@@ -0,0 +1,42 @@
+from api.results import Boxes, Result
+
+# ============================================================
+# STUB DETECTION MODEL (LOAD TEST / CI)
+# ============================================================
+# Thay thế YOLO khi DETECTION_BACKEND=stub: trả về box giả, có tính xác định,
+# cùng interface mà api/functions.py dùng (results[0].boxes, .plot(), .names).
+# Không cần weights, không cần GPU, mỗi lần gọi chỉ tốn vài micro giây.
+
+class StubModel:
+    """
+    Model giả: phát hiện `count` object ở giữa ảnh, số lượng thay đổi theo chu kỳ
+    `period` frame để event stream / recorder / sampler có dữ liệu thay đổi.
+    """
+
+    def __init__(self, names, count=1, period=30, confidence=0.8):
+        self.names = names
+        self.count = count
+        self.period = period
+        self.confidence = confidence
+        self._calls = 0
+
+    def to(self, device):
+        return self
+
+    def fuse(self):
+        return self
+
+    def __call__(self, image, conf=0.25, classes=None, **kwargs):
+        self._calls += 1
+        height, width = image.shape[:2]
+        count = self.count if (self._calls // self.period) % 2 == 0 else 0
+        if self.confidence < conf:
+            count = 0
+
+        boxes = []
+        for i in range(count):
+            offset = i * width // (4 * max(1, count))
+            boxes.append([width // 4 + offset, height // 4, width * 3 // 4 + offset, height * 3 // 4])
+        cls_id = classes[0] if classes else 0
+        result = Result(image, Boxes(boxes, [self.confidence] * count, [cls_id] * count), self.names)
+        return [result]
@@ -0,0 +1,87 @@
+# make_labels.py
+
+import os
+import sys
+import json
+import argparse
+import yaml
+
+# Thư mục mặc định mà API (api/hard_examples.py) lưu hard examples
+DEFAULT_SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "hard_examples")
+
+def to_yolo_line(badge, width, height):
+    """
+    Chuyển box xyxy (pixel) thành dòng label YOLO: class cx cy w h (chuẩn hóa 0-1)
+    """
+    x1, y1, x2, y2 = badge["box"]
+    x1, x2 = max(0.0, x1), min(float(width), x2)
+    y1, y2 = max(0.0, y1), min(float(height), y2)
+    cx = (x1 + x2) / 2 / width
+    cy = (y1 + y2) / 2 / height
+    w = (x2 - x1) / width
+    h = (y2 - y1) / height
+    return f"{badge['class']} {cx:.6f} {cy:.6f} {w:.6f} {h:.6f}"
+
+def make_labels(sample_dir, min_confidence=0.0, overwrite=False):
+    """
+    Tạo file label YOLO (labels/<id>.txt) từ meta/<id>.json.
+    Label chỉ là bản nháp (pre-annotation) từ dự đoán của model, cần được
+    kiểm tra / sửa lại trong công cụ gán nhãn trước khi đưa vào train.py.
+    Không ghi đè label đã có (đã được sửa tay) trừ khi overwrite=True.
+    """
+    meta_dir = os.path.join(sample_dir, "meta")
+    labels_dir = os.path.join(sample_dir, "labels")
+    os.makedirs(labels_dir, exist_ok=True)
+
+    created = 0
+    skipped = 0
+    for name in sorted(os.listdir(meta_dir)):
+        if not name.endswith(".json"):
+            continue
+        label_path = os.path.join(labels_dir, name[:-5] + ".txt")
+        if os.path.exists(label_path) and not overwrite:
+            skipped += 1
+            continue
+
+        with open(os.path.join(meta_dir, name)) as f:
+            meta = json.load(f)
+
+        lines = [
+            to_yolo_line(badge, meta["width"], meta["height"])
+            for badge in meta.get("badges", [])
+            if badge["confidence"] >= min_confidence
+        ]
+        with open(label_path, "w") as f:
+            f.write("\n".join(lines) + ("\n" if lines else ""))
+        created += 1
+
+    print(f"Đã tạo {created} label, bỏ qua {skipped} label đã có trong: {labels_dir}")
+    return created
+
+def write_dataset_yaml(sample_dir, class_names):
+    """
+    Ghi dataset.yaml để dùng làm `data:` trong config.yaml của train.py
+    """
+    dataset_yaml = os.path.join(sample_dir, "dataset.yaml")
+    with open(dataset_yaml, "w") as f:
+        yaml.safe_dump({
+            "path": os.path.abspath(sample_dir),
+            "train": "images",
+            "val": "images",
+            "names": {i: name for i, name in enumerate(class_names)}
+        }, f, sort_keys=False)
+    print(f"Dataset config đã được lưu tại: {dataset_yaml}")
+    return dataset_yaml
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Tạo label YOLO nháp từ hard examples thu thập bởi API")
+    parser.add_argument('--dir', default=DEFAULT_SAMPLE_DIR, help="Thư mục hard examples (images/ + meta/)")
+    parser.add_argument('--min-confidence', type=float, default=0.0, help="Bỏ các box có confidence thấp hơn")
+    parser.add_argument('--overwrite', action='store_true', help="Ghi đè label đã có")
+    parser.add_argument('--names', nargs='+', default=['badge'], help="Tên các class theo thứ tự id")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    make_labels(args.dir, args.min_confidence, args.overwrite)
+    write_dataset_yaml(args.dir, args.names)
@@ -1,76 +1,93 @@
 # train.py
 
 import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 import yaml
+import numpy as np
 from ultralytics import YOLO
 import matplotlib.pyplot as plt
 import pandas as pd # Để đọc file kết quả dễ dàng hơn
 
-def train_yolov8(config_path):
+# Các tham số trong config.yaml được truyền thẳng vào YOLO.train
+TRAIN_KEYS = [
+    'epochs', 'imgsz', 'workers', 'patience', 'optimizer', 'lr0', 'lrf', 'momentum',
+    'weight_decay', 'warmup_epochs', 'warmup_momentum', 'warmup_bias_lr', 'box', 'cls',
+    'dfl', 'hsv_h', 'hsv_s', 'hsv_v', 'degrees', 'translate', 'scale', 'shear',
+    'perspective', 'flipud', 'fliplr', 'mosaic', 'mixup', 'copy_paste', 'project',
+    'name', 'exist_ok'
+]
+
+# Thư mục models mà API load (src/core/models)
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models")
+
+def load_config(config_path):
+    print(f"Đang tải cấu hình từ: {config_path}")
+    with open(config_path, 'r') as f:
+        return yaml.safe_load(f)
+
+def find_last_checkpoint(cfg):
+    """
+    Tìm weights/last.pt của lần chạy trước (project/name) để resume.
+    """
+    last = os.path.join(cfg['project'], cfg['name'], 'weights', 'last.pt')
+    return last if os.path.exists(last) else None
+
+def train_yolov8(config_path, cfg=None, resume=False):
     """
     Huấn luyện mô hình YOLOv8 và trả về đường dẫn đến thư mục chứa kết quả.
+
+    - **cfg**: dict cấu hình (nếu None thì đọc từ config_path)
+    - **resume**: tiếp tục từ weights/last.pt nếu có
     """
-    print(f"Đang tải cấu hình từ: {config_path}")
-    with open(config_path, 'r') as f:
-        cfg = yaml.safe_load(f)
-
-    # Khởi tạo mô hình YOLO
-    # Nếu cfg['model'] là None, sẽ dùng khởi tạo ngẫu nhiên
-    model = YOLO(cfg['model']) 
-
-    print("\n--- Bắt đầu huấn luyện YOLOv8 ---")
-    results = model.train(
-        data=cfg['data'],
-        epochs=cfg['epochs'],
-        batch=cfg['batch_size'],
-        imgsz=cfg['imgsz'],
-        workers=cfg['workers'],
-        patience=cfg['patience'],
-        optimizer=cfg['optimizer'],
-        lr0=cfg['lr0'],
-        lrf=cfg['lrf'],
-        momentum=cfg['momentum'],
-        weight_decay=cfg['weight_decay'],
-        warmup_epochs=cfg['warmup_epochs'],
-        warmup_momentum=cfg['warmup_momentum'],
-        warmup_bias_lr=cfg['warmup_bias_lr'],
-        box=cfg['box'],
-        cls=cfg['cls'],
-        dfl=cfg['dfl'],
-        hsv_h=cfg['hsv_h'],
-        hsv_s=cfg['hsv_s'],
-        hsv_v=cfg['hsv_v'],
-        degrees=cfg['degrees'],
-        translate=cfg['translate'],
-        scale=cfg['scale'],
-        shear=cfg['shear'],
-        perspective=cfg['perspective'],
-        flipud=cfg['flipud'],
-        fliplr=cfg['fliplr'],
-        mosaic=cfg['mosaic'],
-        mixup=cfg['mixup'],
-        copy_paste=cfg['copy_paste'],
-        project=cfg['project'],
-        name=cfg['name'],
-        exist_ok=cfg['exist_ok'],
-        save_period=cfg.get('save_period', -1)
-    )
+    if cfg is None:
+        cfg = load_config(config_path)
+
+    last_checkpoint = find_last_checkpoint(cfg) if resume else None
+    if last_checkpoint:
+        # Resume: ultralytics tự đọc lại toàn bộ tham số từ checkpoint
+        print(f"\n--- Tiếp tục huấn luyện từ: {last_checkpoint} ---")
+        model = YOLO(last_checkpoint)
+        model.train(resume=True)
+    else:
+        if resume:
+            print("Không tìm thấy last.pt, bắt đầu huấn luyện mới")
+
+        # Khởi tạo mô hình YOLO
+        # Nếu cfg['model'] là None, sẽ dùng khởi tạo ngẫu nhiên
+        model = YOLO(cfg['model'])
+
+        train_args = {key: cfg[key] for key in TRAIN_KEYS}
+        print("\n--- Bắt đầu huấn luyện YOLOv8 ---")
+        model.train(
+            data=cfg['data'],
+            batch=cfg['batch_size'],
+            # Cache ảnh đã decode + resize: 'ram' hoặc 'disk' (file .npy cạnh ảnh gốc)
+            cache=cfg.get('cache', 'disk'),
+            save_period=cfg.get('save_period', -1),
+            **train_args
+        )
     print("--- Huấn luyện hoàn tất ---")
-    
+
     # ultralytics sẽ trả về một đối tượng chứa đường dẫn thư mục lưu kết quả
     # Cần tìm đường dẫn thực tế của thư mục chạy
     # Ví dụ: runs/train/yolov8_combined
     # Cách tốt nhất là lấy từ thuộc tính `save_dir` của đối tượng trainer
     runs_dir = model.trainer.save_dir
     print(f"Kết quả được lưu tại: {runs_dir}")
-    return runs_dir
+    return str(runs_dir)
 
-def plot_map_curve(runs_dir):
+def plot_map_curve(runs_dir, show=True):
     """
     Đọc file results.csv và vẽ biểu đồ mAP@0.5:0.95 theo epoch.
     """
     results_path = os.path.join(runs_dir, 'results.csv')
-    
+
     if not os.path.exists(results_path):
         print(f"Lỗi: Không tìm thấy file results.csv tại {results_path}")
         return
@@ -78,7 +95,7 @@ def plot_map_curve(runs_dir):
     print(f"\nĐang đọc kết quả từ: {results_path}")
     # Đọc file CSV, bỏ qua dòng đầu tiên (header chứa '#' comment)
     df = pd.read_csv(results_path, comment='#')
-    
+
     # ultralytics lưu mAP@0.5:0.95 dưới cột 'metrics/mAP50-95(B)'
     # và epochs là cột 'epoch'
     epochs = df['epoch']
@@ -92,20 +109,219 @@ def plot_map_curve(runs_dir):
     plt.grid(True)
     plt.xticks(epochs[::len(epochs)//10].astype(int) if len(epochs) > 10 else epochs.astype(int)) # Chỉ hiện 10 tick nếu nhiều quá
     plt.tight_layout()
-    
+
     # Lưu biểu đồ
     plot_save_path = os.path.join(runs_dir, 'mAP_50-95_curve.png')
     plt.savefig(plot_save_path)
     print(f"Biểu đồ mAP đã được lưu tại: {plot_save_path}")
-    plt.show()
+    if show:
+        plt.show()
+    plt.close()
+
+def read_best_metrics(runs_dir):
+    """
+    Lấy metrics của epoch có mAP@0.5:0.95 cao nhất từ results.csv
+    """
+    results_path = os.path.join(runs_dir, 'results.csv')
+    if not os.path.exists(results_path):
+        return {}
+    df = pd.read_csv(results_path, comment='#')
+    df.columns = [c.strip() for c in df.columns]
+    best = df.loc[df['metrics/mAP50-95(B)'].idxmax()]
+    return {
+        "epoch": int(best['epoch']),
+        "mAP50": float(best['metrics/mAP50(B)']),
+        "mAP50-95": float(best['metrics/mAP50-95(B)'])
+    }
+
+# ============================================================
+# BENCHMARK + EXPORT
+# ============================================================
+
+def benchmark_cpu(weights, imgsz=640, runs=50, warmup=5):
+    """
+    Đo latency inference trên CPU (ms) với ảnh giả kích thước imgsz.
+    """
+    model = YOLO(weights)
+    img = np.random.randint(0, 255, (imgsz, imgsz, 3), dtype=np.uint8)
+
+    for _ in range(warmup):
+        model(img, imgsz=imgsz, device='cpu', verbose=False)
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(img, imgsz=imgsz, device='cpu', verbose=False)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings = np.array(timings)
+    result = {
+        "device": "cpu",
+        "imgsz": imgsz,
+        "runs": runs,
+        "mean_ms": round(float(timings.mean()), 2),
+        "p50_ms": round(float(np.percentile(timings, 50)), 2),
+        "p95_ms": round(float(np.percentile(timings, 95)), 2)
+    }
+    print(f"CPU latency ({os.path.basename(str(weights))}): {result}")
+    return result
+
+def export_model(runs_dir, cfg, formats=None):
+    """
+    Benchmark best.pt trên CPU, export sang các định dạng serving và
+    ghi manifest.json (model, formats, classes, metrics, latency) cạnh weights.
+    """
+    weights_dir = os.path.join(runs_dir, 'weights')
+    best = os.path.join(weights_dir, 'best.pt')
+    if not os.path.exists(best):
+        print(f"Lỗi: Không tìm thấy {best}")
+        return None
+
+    imgsz = int(cfg.get('imgsz', 640))
+    formats = formats if formats is not None else cfg.get('export_formats', ['onnx'])
+
+    model = YOLO(best)
+    exports = {"pt": os.path.basename(best)}
+    latency = {"pt": benchmark_cpu(best, imgsz)}
+    for fmt in formats:
+        print(f"\n--- Export {fmt} ---")
+        try:
+            path = model.export(format=fmt, imgsz=imgsz, device='cpu')
+            exports[fmt] = os.path.relpath(str(path), weights_dir)
+            latency[fmt] = benchmark_cpu(str(path), imgsz)
+        except Exception as e:
+            print(f"Export {fmt} thất bại: {e}")
+
+    manifest = {
+        "name": cfg.get('name'),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "imgsz": imgsz,
+        "classes": {int(k): v for k, v in model.names.items()},
+        "metrics": read_best_metrics(runs_dir),
+        "exports": exports,
+        "latency": latency
+    }
+    manifest_path = os.path.join(weights_dir, 'manifest.json')
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Manifest đã được lưu tại: {manifest_path}")
+    return manifest_path
+
+def publish_model(runs_dir, model_name="badge_detect"):
+    """
+    Copy best.pt + manifest sang src/core/models để API sử dụng.
+    """
+    weights_dir = os.path.join(runs_dir, 'weights')
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    shutil.copy2(os.path.join(weights_dir, 'best.pt'), os.path.join(MODELS_DIR, f"{model_name}.pt"))
+    manifest_path = os.path.join(weights_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        # Copy các file export và trỏ manifest tới đúng tên file trong models/
+        for fmt, rel in manifest["exports"].items():
+            src = os.path.join(weights_dir, rel)
+            dst_name = f"{model_name}.pt" if fmt == "pt" else f"{model_name}_{os.path.basename(rel)}"
+            if fmt != "pt":
+                dst = os.path.join(MODELS_DIR, dst_name)
+                if os.path.isdir(src):
+                    shutil.copytree(src, dst, dirs_exist_ok=True)
+                else:
+                    shutil.copy2(src, dst)
+            manifest["exports"][fmt] = dst_name
+        with open(os.path.join(MODELS_DIR, f"{model_name}.json"), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    print(f"Model đã được publish vào: {os.path.abspath(MODELS_DIR)}")
+
+# ============================================================
+# HYPERPARAMETER SWEEP
+# ============================================================
+
+def expand_sweep(cfg):
+    """
+    Tạo danh sách cấu hình từ mục `sweep` trong config.yaml, ví dụ:
+
+        sweep:
+          lr0: [0.01, 0.001]
+          imgsz: [416, 640]
+
+    Mỗi tổ hợp có name riêng: <name>_lr0-0.01_imgsz-416
+    """
+    sweep = cfg.get('sweep') or {}
+    if not sweep:
+        return [cfg]
+
+    keys = list(sweep.keys())
+    configs = []
+    for values in itertools.product(*(sweep[k] for k in keys)):
+        run_cfg = dict(cfg)
+        run_cfg.pop('sweep', None)
+        run_cfg.update(dict(zip(keys, values)))
+        run_cfg['name'] = cfg['name'] + "_" + "_".join(f"{k}-{v}" for k, v in zip(keys, values))
+        configs.append(run_cfg)
+    return configs
+
+def _run_one(args):
+    """Chạy một lần train + export (dùng trong process con)"""
+    config_path, run_cfg, resume, export = args
+    runs_dir = train_yolov8(config_path, cfg=run_cfg, resume=resume)
+    plot_map_curve(runs_dir, show=False)
+    manifest = export_model(runs_dir, run_cfg) if export else None
+    return runs_dir, manifest
+
+def run_sweep(config_path, cfg, parallel=1, resume=False, export=True):
+    """
+    Chạy tất cả cấu hình trong sweep, song song bằng nhiều process.
+    Trả về thư mục của lần chạy có mAP@0.5:0.95 cao nhất.
+    """
+    configs = expand_sweep(cfg)
+    print(f"Sweep: {len(configs)} cấu hình, {parallel} process song song")
+    jobs = [(config_path, run_cfg, resume, export) for run_cfg in configs]
+
+    if parallel > 1:
+        with ProcessPoolExecutor(max_workers=parallel) as pool:
+            results = list(pool.map(_run_one, jobs))
+    else:
+        results = [_run_one(job) for job in jobs]
+
+    best_dir = max(
+        (runs_dir for runs_dir, _ in results),
+        key=lambda d: read_best_metrics(d).get("mAP50-95", -1)
+    )
+    print(f"\nLần chạy tốt nhất: {best_dir} {read_best_metrics(best_dir)}")
+    return best_dir
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Huấn luyện badge detection model (YOLOv8)")
+    parser.add_argument('--config', default='config.yaml', help="Đường dẫn config.yaml")
+    parser.add_argument('--resume', action='store_true', help="Tiếp tục từ weights/last.pt")
+    parser.add_argument('--sweep', action='store_true', help="Chạy các tổ hợp trong mục `sweep` của config")
+    parser.add_argument('--parallel', type=int, default=1, help="Số process chạy song song khi sweep")
+    parser.add_argument('--no-export', action='store_true', help="Bỏ qua benchmark + export")
+    parser.add_argument('--publish', action='store_true', help="Copy model tốt nhất + manifest sang src/core/models")
+    parser.add_argument('--no-show', action='store_true', help="Không mở cửa sổ biểu đồ mAP")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
     # Đảm bảo file config.yaml nằm cùng thư mục với train.py
-    config_file = 'config.yaml' 
-    
-    # 1. Thực hiện huấn luyện
-    final_runs_directory = train_yolov8(config_file)
-    
-    # 2. Vẽ biểu đồ mAP sau khi huấn luyện
-    if final_runs_directory:
-        plot_map_curve(final_runs_directory)
\ No newline at end of file
+    cfg = load_config(args.config)
+
+    if args.sweep:
+        # 1. Chạy sweep (train + export cho từng cấu hình)
+        final_runs_directory = run_sweep(args.config, cfg, args.parallel, args.resume, not args.no_export)
+    else:
+        # 1. Thực hiện huấn luyện
+        final_runs_directory = train_yolov8(args.config, cfg=cfg, resume=args.resume)
+
+        # 2. Vẽ biểu đồ mAP sau khi huấn luyện
+        if final_runs_directory:
+            plot_map_curve(final_runs_directory, show=not args.no_show)
+
+        # 3. Benchmark CPU + export sang các định dạng serving
+        if final_runs_directory and not args.no_export:
+            export_model(final_runs_directory, cfg)
+
+    # 4. Publish sang thư mục models của API
+    if final_runs_directory and args.publish:
+        publish_model(final_runs_directory)
@@ -0,0 +1,547 @@
+# run.py
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+
+import cv2
+
+# ============================================================
+# LOAD TEST HARNESS
+# ============================================================
+# Tạo tải đồng thời lên FastAPI backend:
+# - replay request mix (JSONL, xem request_mix.jsonl) với N worker
+# - giả lập webcam client (ui/webcam*.html): POST frame JPEG theo chu kỳ
+# - giả lập MJPEG viewer: mở /…/stream và đếm frame nhận được
+# - bulk burst (--bulk-burst N): N upload X-Priority: bulk cùng lúc giữa test,
+#   kiểm tra khoảng cách frame của live stream không tăng trong lúc burst
+# - đo throughput, latency percentile, frame bị drop, CPU / RSS của server
+#
+# Chạy hoàn toàn offline:
+#   python loadtest/run.py --spawn --stub --video sample.mp4 --duration 30
+# (--spawn khởi động uvicorn cục bộ với DETECTION_BACKEND=stub và CAMERA_VIDEO_FILE)
+
+CORE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DEFAULT_MIX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "request_mix.jsonl")
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+class Stats:
+    """
+    Gom latency (ms) và lỗi theo tên request, thread-safe.
+    Percentile chỉ tính trên request thành công; lỗi (status != 2xx, mất kết nối)
+    được đếm riêng để không kéo p50/p90 xuống.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, latency_ms, ok):
+        if not ok:
+            self.error(name)
+            return
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            self.latencies.setdefault(name, []).append(latency_ms)
+
+    def error(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def report(self, duration):
+        result = {}
+        for name, count in sorted(self.requests.items()):
+            values = self.latencies.get(name, [])
+            result[name] = {
+                "requests": count,
+                "errors": self.errors.get(name, 0),
+                "throughput_rps": round(count / duration, 2),
+                "p50_ms": percentile(values, 50),
+                "p90_ms": percentile(values, 90),
+                "p99_ms": percentile(values, 99),
+                "max_ms": round(max(values), 2) if values else None
+            }
+        return result
+
+# ============================================================
+# HTTP HELPERS (STDLIB ONLY)
+# ============================================================
+
+def make_connection(target, timeout=30):
+    parsed = urllib.parse.urlparse(target)
+    cls = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    return cls(parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80), timeout=timeout)
+
+def encode_multipart(field, filename, data, content_type="image/jpeg"):
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def send_request(conn, method, path, params=None, upload=None, headers=None):
+    """Gửi request, đọc hết body. Trả về (status, latency_ms)"""
+    url = path + ("?" + urllib.parse.urlencode(params) if params else "")
+    headers = dict(headers or {})
+    body = None
+    if upload is not None:
+        body, headers["Content-Type"] = encode_multipart("file", "frame.jpg", upload)
+
+    start = time.perf_counter()
+    conn.request(method, url, body=body, headers=headers)
+    response = conn.getresponse()
+    response.read()
+    return response.status, (time.perf_counter() - start) * 1000
+
+def wait_for_health(target, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = make_connection(target, timeout=2)
+            status, _ = send_request(conn, "GET", "/health")
+            conn.close()
+            if status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.5)
+    return False
+
+# ============================================================
+# FRAME SOURCE
+# ============================================================
+
+def load_frames(video_path=None, image_path=None, limit=120, quality=90):
+    """
+    Lấy danh sách JPEG bytes để upload: từ ảnh, từ file video, hoặc ảnh tổng hợp.
+    """
+    if image_path:
+        with open(image_path, "rb") as f:
+            return [f.read()]
+
+    frames = []
+    if video_path:
+        cap = cv2.VideoCapture(video_path)
+        while len(frames) < limit:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            ok, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if ok:
+                frames.append(buffer.tobytes())
+        cap.release()
+
+    if not frames:
+        import numpy as np
+        frame = np.random.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+        frames.append(cv2.imencode(".jpg", frame)[1].tobytes())
+    return frames
+
+def video_fps(video_path, default=30.0):
+    if not video_path:
+        return default
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return fps if fps and fps > 0 else default
+
+# ============================================================
+# WORKLOADS
+# ============================================================
+
+def load_mix(path):
+    mix = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                mix.append(json.loads(line))
+    return mix
+
+def replay_worker(target, mix, frames, stats, stop):
+    """Chọn request theo weight trong mix và gửi liên tục đến khi stop"""
+    weights = [entry.get("weight", 1) for entry in mix]
+    conn = make_connection(target)
+    while not stop.is_set():
+        entry = random.choices(mix, weights=weights)[0]
+        upload = random.choice(frames) if entry.get("upload") else None
+        try:
+            status, latency = send_request(conn, entry.get("method", "GET"), entry["path"], entry.get("params"),
+                                           upload, entry.get("headers"))
+            stats.add(entry["name"], latency, 200 <= status < 300)
+        except (OSError, http.client.HTTPException):
+            stats.error(entry["name"])
+            conn.close()
+            conn = make_connection(target)
+    conn.close()
+
+def webcam_client(target, endpoint, interval, frames, stats, stop, counters):
+    """
+    Giả lập trang webcam*.html: mỗi `interval` giây POST một frame.
+    Nếu request trước chưa xong khi đến lượt thì frame đó bị tính là drop.
+    """
+    conn = make_connection(target)
+    next_tick = time.time()
+    index = 0
+    while not stop.is_set():
+        now = time.time()
+        if now < next_tick:
+            time.sleep(min(next_tick - now, 0.05))
+            continue
+        missed = int((now - next_tick) // interval)
+        if missed:
+            counters["webcam_dropped"] += missed
+        next_tick += (missed + 1) * interval
+
+        try:
+            status, latency = send_request(conn, "POST", endpoint, upload=frames[index % len(frames)])
+            stats.add(f"webcam {endpoint}", latency, 200 <= status < 300)
+        except (OSError, http.client.HTTPException):
+            stats.error(f"webcam {endpoint}")
+            conn.close()
+            conn = make_connection(target)
+        counters["webcam_sent"] += 1
+        index += 1
+    conn.close()
+
+def mjpeg_viewer(target, endpoint, params, stop, results):
+    """
+    Mở MJPEG stream, đếm frame và khoảng cách giữa các frame.
+    Stream bị đóng trước khi test kết thúc (lỗi server, camera không reconnect được)
+    được đánh dấu failed.
+    """
+    viewer = {"endpoint": endpoint, "frames": 0, "bytes": 0, "gaps_ms": [], "gap_times": [], "error": None,
+              "active_s": 0.0, "failed": False}
+    results.append(viewer)
+    marker = b"--frame"
+    start = time.time()
+    try:
+        conn = make_connection(target, timeout=10)
+        conn.request("GET", endpoint + "?" + urllib.parse.urlencode(params))
+        response = conn.getresponse()
+        tail = b""
+        last = None
+        while not stop.is_set():
+            chunk = response.read1(65536) if hasattr(response, "read1") else response.read(4096)
+            if not chunk:
+                viewer["error"] = "stream closed by server"
+                break
+            viewer["bytes"] += len(chunk)
+            data = tail + chunk
+            count = data.count(marker)
+            tail = data[-(len(marker) - 1):]
+            for _ in range(count):
+                now = time.time()
+                if last is not None:
+                    viewer["gaps_ms"].append((now - last) * 1000)
+                    viewer["gap_times"].append(now)
+                last = now
+                viewer["frames"] += 1
+        conn.close()
+    except (OSError, http.client.HTTPException) as e:
+        viewer["error"] = str(e)
+    viewer["active_s"] = time.time() - start
+    viewer["failed"] = viewer["error"] is not None
+
+def bulk_burst(target, endpoint, count, frames, stats, window):
+    """
+    Gửi `count` upload X-Priority: bulk cùng lúc (mỗi upload một kết nối).
+    Ghi thời điểm bắt đầu / kết thúc burst vào `window`.
+    """
+    def send(index):
+        conn = make_connection(target, timeout=60)
+        try:
+            status, latency = send_request(conn, "POST", endpoint, upload=frames[index % len(frames)],
+                                           headers={"X-Priority": "bulk"})
+            stats.add(f"bulk burst {endpoint}", latency, 200 <= status < 300)
+        except (OSError, http.client.HTTPException):
+            stats.error(f"bulk burst {endpoint}")
+        finally:
+            conn.close()
+
+    window["start"] = time.time()
+    senders = [threading.Thread(target=send, args=(i,), daemon=True) for i in range(count)]
+    for t in senders:
+        t.start()
+    for t in senders:
+        t.join(timeout=90)
+    window["end"] = time.time()
+
+def live_gap_check(viewers, window, max_ratio, settle=1.0):
+    """
+    So sánh gap p99 của live stream trước burst (baseline) và trong burst
+    (đến `settle` giây sau khi burst kết thúc). passed khi burst p99 <= max_ratio x baseline p99.
+    """
+    if "start" not in window:
+        return None
+    baseline, burst = [], []
+    for v in viewers:
+        for at, gap in zip(v["gap_times"], v["gaps_ms"]):
+            if at < window["start"]:
+                baseline.append(gap)
+            elif at <= window.get("end", at) + settle:
+                burst.append(gap)
+    baseline_p99 = percentile(baseline, 99)
+    burst_p99 = percentile(burst, 99)
+    if baseline_p99 is None or burst_p99 is None:
+        return {"baseline_p99_ms": baseline_p99, "burst_p99_ms": burst_p99, "max_gap_ms": None, "passed": False}
+    return {
+        "burst_duration_s": round(window.get("end", time.time()) - window["start"], 2),
+        "baseline_p99_ms": baseline_p99,
+        "burst_p99_ms": burst_p99,
+        "max_gap_ms": round(max(burst), 2),
+        "max_ratio": max_ratio,
+        "passed": burst_p99 <= baseline_p99 * max_ratio
+    }
+
+# ============================================================
+# SERVER PROCESS + RESOURCE SAMPLING
+# ============================================================
+
+def spawn_server(port, stub, video, workdir):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONUNBUFFERED": "1",
+        "EVENT_STORE_PATH": os.path.join(workdir, "events.db"),
+        "RECORDER_DIR": os.path.join(workdir, "clips"),
+        "SAMPLER_DIR": os.path.join(workdir, "hard_examples"),
+        "RUNTIME_PROFILE_PATH": os.path.join(workdir, "runtime_profile.json")
+    })
+    if stub:
+        env["DETECTION_BACKEND"] = "stub"
+        env["RUNTIME_AUTOTUNE"] = "0"
+    if video:
+        env["CAMERA_VIDEO_FILE"] = os.path.abspath(video)
+    log = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=CORE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    return process, log
+
+class ResourceSampler:
+    """Lấy mẫu CPU% và RSS của process server từ /proc (Linux)"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.cpu = []
+        self.rss_mb = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def _read(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_ticks = int(fields[11]) + int(fields[12])
+        rss = 0
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+        return cpu_ticks, rss
+
+    def _loop(self):
+        try:
+            last_ticks, _ = self._read()
+        except OSError:
+            return
+        last_time = time.time()
+        while not self._stop.wait(self.interval):
+            try:
+                ticks, rss = self._read()
+            except OSError:
+                return
+            now = time.time()
+            self.cpu.append((ticks - last_ticks) / self._ticks / (now - last_time) * 100)
+            self.rss_mb.append(rss)
+            last_ticks, last_time = ticks, now
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+
+    def report(self):
+        if not self.cpu:
+            return None
+        return {
+            "cpu_percent_avg": round(sum(self.cpu) / len(self.cpu), 1),
+            "cpu_percent_max": round(max(self.cpu), 1),
+            "rss_mb_avg": round(sum(self.rss_mb) / len(self.rss_mb), 1),
+            "rss_mb_max": round(max(self.rss_mb), 1)
+        }
+
+# ============================================================
+# MAIN
+# ============================================================
+
+def run(args):
+    frames = load_frames(args.video, args.image)
+    source_fps = video_fps(args.video, args.source_fps)
+    target = args.target
+    process = log = None
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+
+    if args.spawn:
+        target = f"http://127.0.0.1:{args.port}"
+        process, log = spawn_server(args.port, args.stub, args.video, workdir)
+        print(f"Started server pid={process.pid}, logs: {os.path.join(workdir, 'server.log')}")
+
+    try:
+        if not wait_for_health(target):
+            print("Server không phản hồi /health")
+            return None
+
+        sampler = None
+        pid = process.pid if process else args.server_pid
+        if pid and os.path.exists(f"/proc/{pid}"):
+            sampler = ResourceSampler(pid)
+            sampler.start()
+
+        stats = Stats()
+        stop = threading.Event()
+        counters = {"webcam_sent": 0, "webcam_dropped": 0}
+        viewers = []
+        threads = []
+        burst_window = {}
+
+        mix = load_mix(args.mix) if args.concurrency > 0 else []
+        for _ in range(args.concurrency):
+            threads.append(threading.Thread(target=replay_worker, args=(target, mix, frames, stats, stop)))
+        for _ in range(args.webcam_clients):
+            threads.append(threading.Thread(target=webcam_client, args=(
+                target, args.webcam_endpoint, args.webcam_interval / 1000.0, frames, stats, stop, counters)))
+        for _ in range(args.viewers):
+            threads.append(threading.Thread(target=mjpeg_viewer, args=(
+                target, args.viewer_endpoint, {"source": 0}, stop, viewers)))
+
+        print(f"Running {len(threads)} clients for {args.duration}s against {target}")
+        start = time.time()
+        for t in threads:
+            t.daemon = True
+            t.start()
+        if args.bulk_burst > 0:
+            # Burst sau 1/3 thời gian test để viewer có baseline
+            time.sleep(args.duration / 3)
+            burst = threading.Thread(target=bulk_burst, args=(
+                target, args.bulk_endpoint, args.bulk_burst, frames, stats, burst_window), daemon=True)
+            burst.start()
+            time.sleep(max(0.0, start + args.duration - time.time()))
+        else:
+            time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join(timeout=15)
+        duration = time.time() - start
+
+        if sampler:
+            sampler.stop()
+
+        viewer_report = []
+        for v in viewers:
+            expected = int(source_fps * v["active_s"])
+            if v["failed"]:
+                print(f"Viewer {v['endpoint']} failed after {v['active_s']:.1f}s: {v['error']}")
+            viewer_report.append({
+                "endpoint": v["endpoint"],
+                "failed": v["failed"],
+                "frames": v["frames"],
+                "fps": round(v["frames"] / v["active_s"], 2) if v["active_s"] else 0,
+                # Viewer bị đóng sớm không có frame drop có ý nghĩa
+                "dropped_frames": None if v["failed"] else max(0, expected - v["frames"]),
+                "gap_p50_ms": percentile(v["gaps_ms"], 50),
+                "gap_p99_ms": percentile(v["gaps_ms"], 99),
+                "mbytes": round(v["bytes"] / 1e6, 2),
+                "error": v["error"]
+            })
+
+        total_requests = stats.total()
+        report = {
+            "target": target,
+            "duration_s": round(duration, 1),
+            "clients": {"replay": args.concurrency, "webcam": args.webcam_clients, "viewers": args.viewers},
+            "throughput_rps": round(total_requests / duration, 2),
+            "requests": stats.report(duration),
+            "webcam": counters,
+            "viewers": viewer_report,
+            "viewers_failed": sum(1 for v in viewer_report if v["failed"]),
+            "live_gap_check": live_gap_check(viewers, burst_window, args.max_gap_ratio) if viewers else None,
+            "server": sampler.report() if sampler else None
+        }
+        return report
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test cho detection API")
+    parser.add_argument('--target', default="http://127.0.0.1:6034", help="URL của server (bỏ qua nếu --spawn)")
+    parser.add_argument('--spawn', action='store_true', help="Tự khởi động uvicorn cục bộ")
+    parser.add_argument('--port', type=int, default=6099, help="Port cho server khi --spawn")
+    parser.add_argument('--stub', action='store_true', help="Dùng stub model (DETECTION_BACKEND=stub) khi --spawn")
+    parser.add_argument('--video', help="File video: nguồn camera (CAMERA_VIDEO_FILE) và frame để upload")
+    parser.add_argument('--image', help="Ảnh JPEG dùng cho upload")
+    parser.add_argument('--source-fps', type=float, default=30.0, help="FPS nguồn (khi không có --video) để tính frame drop")
+    parser.add_argument('--server-pid', type=int, help="PID server để đo CPU/RSS (khi không --spawn)")
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="Request mix (JSONL)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Số worker replay request mix")
+    parser.add_argument('--webcam-clients', type=int, default=0)
+    parser.add_argument('--webcam-endpoint', default="/detect_combined_by_image")
+    parser.add_argument('--webcam-interval', type=float, default=500, help="Chu kỳ gửi frame (ms)")
+    parser.add_argument('--viewers', type=int, default=0,
+                        help="Số MJPEG viewer (cùng camera: dùng chung một detection loop)")
+    parser.add_argument('--viewer-endpoint', default="/combined/stream")
+    parser.add_argument('--bulk-burst', type=int, default=0,
+                        help="Số upload X-Priority: bulk gửi cùng lúc giữa test (cần --viewers để kiểm tra live gap)")
+    parser.add_argument('--bulk-endpoint', default="/detect_combined_by_image")
+    parser.add_argument('--max-gap-ratio', type=float, default=3.0,
+                        help="live_gap_check fail khi gap p99 trong burst > ratio x gap p99 trước burst")
+    parser.add_argument('--output', help="Ghi report JSON ra file")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    report = run(args)
+    if report is None:
+        sys.exit(1)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if report["live_gap_check"] and not report["live_gap_check"]["passed"]:
+        print("live_gap_check FAILED: live stream gaps grew during the bulk burst")
+        sys.exit(2)